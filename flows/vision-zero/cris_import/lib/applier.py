@@ -0,0 +1,118 @@
+import psycopg2
+
+import lib.sql as util
+from lib.jsonlines import JsonLinesWriter
+
+# This file applies the INSERT and UPDATE statements which align the VZDB with the imported records. Statements
+# are grouped into batches which are each committed as one transaction, and every statement runs under its own
+# savepoint, so a statement which fails is rolled back on its own and the rest of its batch is kept. A failed
+# statement is written to a JSON lines rejects file, along with the statement and the values bound to it, so it
+# can be looked into and retried by itself.
+#
+# A batch size of 0 keeps the original behavior of committing each statement as soon as it has run.
+#
+# The rejects file of a logical group is shared by every connection applying its statements, including the
+# workers of `ApplyScheduler`.
+
+
+class RejectsFile(JsonLinesWriter):
+    def write(self, table, where, statement, parameters, error):
+        print(
+            f"There is likely an issue with existing data. Try looking for results in {table} with the following WHERE clause:\n'{where}'"
+        )
+        self.write_line(
+            {
+                "table": table,
+                "where": where,
+                "statement": statement,
+                "parameters": parameters,
+                "error": str(error).strip(),
+            }
+        )
+
+
+class StatementApplier:
+    def __init__(self, pg, batch_size, rejects, dry_run):
+        """
+        Arguments:
+            pg: A psycopg2 connection
+            batch_size: How many statements to commit as one transaction, or 0 to commit each one
+            rejects: The RejectsFile the statements which fail are written to
+            dry_run: If set, nothing is applied
+        """
+        self.pg = pg
+        self.batch_size = batch_size
+        self.rejects = rejects
+        self.dry_run = dry_run
+        self.pending = 0
+        self.applied = 0
+        self.rejected = 0
+        self.commits = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+
+    def apply(self, output_map, table, public_key_sql, sql, parameters=None, template=None):
+        """
+        Run a statement as part of the current batch.
+
+        Arguments:
+            output_map: The mapping of imported table names to VZDB table names
+            table: The name of the imported table, such as `crash`
+            public_key_sql: A WHERE clause which picks out the affected records, used to report a failure
+            sql: The statement to run
+            parameters: The values to bind to the statement, if any
+            template: The statement's SQL to record for a failure, if `sql` only executes a prepared statement
+
+        Returns: Whether the statement was applied
+        """
+        if self.dry_run:
+            print("Dry run; skipping")
+            return False
+
+        if not self.batch_size:
+            applied = util.try_statement(self.pg, output_map, table, public_key_sql, sql, False, parameters)
+            self.applied += applied
+            self.rejected += not applied
+            self.commits += 1
+            return applied
+
+        cursor = self.pg.cursor()
+        cursor.execute("savepoint apply_statement")
+        applied = True
+        try:
+            cursor.execute(sql, parameters)
+        except psycopg2.Error as error:
+            cursor.execute("rollback to savepoint apply_statement")
+            self.reject(output_map, table, public_key_sql, template or sql, parameters, error)
+            applied = False
+        else:
+            self.applied += 1
+        cursor.execute("release savepoint apply_statement")
+
+        self.pending += 1
+        if self.pending >= self.batch_size:
+            self.commit()
+        return applied
+
+    def reject(self, output_map, table, public_key_sql, sql, parameters, error):
+        self.rejects.write(output_map[table], public_key_sql, sql, parameters, error)
+        self.rejected += 1
+
+    def commit(self):
+        if self.pending:
+            self.pg.commit()
+            self.commits += 1
+            self.pending = 0
+
+    def get_report(self):
+        return {
+            "applied": self.applied,
+            "rejected": self.rejected,
+            "commits": self.commits,
+            "rejects_path": self.rejects.get_path(),
+        }
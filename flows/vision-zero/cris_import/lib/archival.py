@@ -0,0 +1,172 @@
+import os
+import gzip
+import shutil
+import hashlib
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas
+import zstandard
+import botocore.exceptions
+from boto3.s3.transfer import TransferConfig
+
+# This file archives the files of CRIS extracts to S3. Files are uploaded several at a time, and each of them
+# in parts, side by side, once it's large enough. Each file can be compressed, or for CSVs converted to
+# Parquet, on its way up. The checksum of a file's original contents is stored with the object it's uploaded
+# to, so a file which has already been archived in the same format, by this run or an earlier one, is skipped.
+
+FORMATS = {
+    "none": "",
+    "gzip": ".gz",
+    "zstd": ".zst",
+    "parquet": ".parquet",
+}
+
+MULTIPART_THRESHOLD = 16 * 1024 * 1024
+MULTIPART_CHUNKSIZE = 16 * 1024 * 1024
+COPY_BLOCK_SIZE = 1024 * 1024
+
+# files are staged in memory while they're prepared for upload, unless they're larger than this
+SPOOL_SIZE = 64 * 1024 * 1024
+
+
+def get_transfer_config(max_concurrency):
+    return TransferConfig(
+        multipart_threshold=MULTIPART_THRESHOLD,
+        multipart_chunksize=MULTIPART_CHUNKSIZE,
+        max_concurrency=max_concurrency,
+        use_threads=True,
+    )
+
+
+class HashingReader:
+    """
+    A read-only file-like wrapper which hashes what's read through it.
+    """
+
+    def __init__(self, file):
+        self.file = file
+        self.checksum = hashlib.sha256()
+
+    def read(self, size=-1):
+        data = self.file.read(size)
+        self.checksum.update(data)
+        return data
+
+    def hexdigest(self):
+        # anything which wasn't read is still part of the file's contents
+        for block in iter(lambda: self.read(COPY_BLOCK_SIZE), b""):
+            pass
+        return self.checksum.hexdigest()
+
+
+def prepare_upload(file, filename, archive_format):
+    """
+    Copy a file into a temporary file, in the format it's to be archived in, hashing its original contents along the way.
+
+    Returns: A tuple of the temporary file, rewound, and the checksum of the original contents
+    """
+    source = HashingReader(file)
+    staged = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+
+    if archive_format == "gzip":
+        # without a timestamp in its header, the same file is always compressed to the same bytes
+        with gzip.GzipFile(fileobj=staged, mode="wb", mtime=0) as compressed:
+            shutil.copyfileobj(source, compressed, COPY_BLOCK_SIZE)
+    elif archive_format == "zstd":
+        with zstandard.ZstdCompressor().stream_writer(staged, closefd=False) as compressed:
+            shutil.copyfileobj(source, compressed, COPY_BLOCK_SIZE)
+    elif archive_format == "parquet" and filename.endswith(".csv"):
+        # every column is kept as the text CRIS sent it, as the CSVs are
+        data = pandas.read_csv(source, dtype=str, keep_default_na=False)
+        data.to_parquet(staged, engine="pyarrow", compression="zstd", index=False)
+    else:
+        shutil.copyfileobj(source, staged, COPY_BLOCK_SIZE)
+
+    checksum = source.hexdigest()
+    staged.seek(0)
+    return staged, checksum
+
+
+def get_object_key(destination_path, filename, archive_format):
+    if archive_format == "parquet" and not filename.endswith(".csv"):
+        return destination_path + "/" + filename
+    if archive_format == "parquet":
+        return destination_path + "/" + os.path.splitext(filename)[0] + FORMATS["parquet"]
+    return destination_path + "/" + filename + FORMATS[archive_format]
+
+
+def is_archived(s3, bucket_name, key, checksum, archive_format):
+    try:
+        metadata = s3.head_object(Bucket=bucket_name, Key=key)["Metadata"]
+    except botocore.exceptions.ClientError as error:
+        if error.response["Error"]["Code"] in ("404", "NoSuchKey", "NotFound"):
+            return False
+        raise
+    return metadata.get("source-sha256") == checksum and metadata.get("archive-format") == archive_format
+
+
+def archive_file(s3, bucket_name, open_file, filename, destination_path, archive_format, transfer_config):
+    """
+    Archive one file to S3, unless an object holding the same contents in the same format is already there.
+
+    Arguments:
+        s3: A boto3 S3 client, which unlike the S3 resource is safe to share between threads
+        bucket_name: The name of the bucket
+        open_file: A callable which returns a context manager holding the file opened as bytes
+        filename: The name of the file
+        destination_path: The prefix of the object's key in the bucket
+        archive_format: One of the keys of `FORMATS`
+        transfer_config: A boto3 TransferConfig
+
+    Returns: A dictionary describing what was done with the file
+    """
+    key = get_object_key(destination_path, filename, archive_format)
+    with open_file() as file:
+        staged, checksum = prepare_upload(file, filename, archive_format)
+
+    with staged:
+        staged.seek(0, os.SEEK_END)
+        size = staged.tell()
+        staged.seek(0)
+
+        if is_archived(s3, bucket_name, key, checksum, archive_format):
+            return {"key": key, "bytes": size, "skipped": True}
+
+        s3.upload_fileobj(
+            staged,
+            bucket_name,
+            key,
+            ExtraArgs={"Metadata": {"source-sha256": checksum, "archive-format": archive_format}},
+            Config=transfer_config,
+        )
+    return {"key": key, "bytes": size, "skipped": False}
+
+
+def archive_files(s3, bucket_name, files, destination_path, archive_format, max_workers):
+    """
+    Archive several files to S3 at the same time.
+
+    Arguments:
+        s3: A boto3 S3 client, which unlike the S3 resource is safe to share between threads
+        bucket_name: The name of the bucket
+        files: A list of (file name, callable returning the opened file) tuples
+        destination_path: The prefix of the objects' keys in the bucket
+        archive_format: One of the keys of `FORMATS`
+        max_workers: How many files may be uploaded at the same time
+
+    Returns: A list of dictionaries, each describing what was done with a file
+    """
+    if archive_format not in FORMATS:
+        raise ValueError(f"Unknown archive format {archive_format}, expected one of {list(FORMATS)}")
+    if not files:
+        return []
+
+    # each file's parts are uploaded side by side too, so the threads are shared out between the files in flight
+    transfer_config = get_transfer_config(max(1, max_workers // min(len(files), max_workers)))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [
+            executor.submit(archive_file, s3, bucket_name, open_file, filename, destination_path, archive_format, transfer_config)
+            for filename, open_file in files
+        ]
+        return [future.result() for future in futures]
@@ -0,0 +1,133 @@
+import os
+import json
+
+import psycopg2.extras
+
+import lib.mappings as mappings
+
+# This file holds a snapshot of the column metadata the CRIS import needs from `information_schema.columns`.
+# The columns of the VZDB target tables and of a logical group's import schema are read in a single query,
+# and the SQL helpers then look their columns up in the snapshot instead of querying the catalog each time.
+# The target table portion of a snapshot can be written to disk, keyed by a fingerprint of those tables,
+# so a later run against an unchanged schema can skip scanning `information_schema` for them.
+
+
+class CatalogSnapshot:
+    """
+    Column metadata, as returned by `information_schema.columns`, indexed by schema and table.
+    """
+
+    def __init__(self, columns):
+        self.columns_by_table = {}
+        for column in columns:
+            key = (column["table_schema"], column["table_name"])
+            self.columns_by_table.setdefault(key, []).append(dict(column))
+
+    def get_columns(self, schema, table):
+        return self.columns_by_table.get((schema, table), [])
+
+    def get_column(self, schema, table, column_name):
+        for column in self.get_columns(schema, table):
+            if column["column_name"] == column_name:
+                return column
+        return None
+
+    def get_tables(self, schema):
+        return [table for (table_schema, table) in self.columns_by_table.keys() if table_schema == schema]
+
+    def get_schema_columns(self, schema):
+        schema_columns = []
+        for table in self.get_tables(schema):
+            schema_columns.extend(self.get_columns(schema, table))
+        return schema_columns
+
+    def apply_column_types(self, schema, table, typed_columns):
+        # keep the snapshot current after `align_db_typing` has retyped an import table
+        for typed_column in typed_columns:
+            column = self.get_column(schema, table, typed_column["column_name"])
+            if column:
+                column["data_type"] = typed_column["data_type"]
+                column["max_length"] = typed_column["max_length"]
+                column["octet_length"] = typed_column["octet_length"]
+
+    def merge(self, other):
+        for key, columns in other.columns_by_table.items():
+            self.columns_by_table[key] = columns
+        return self
+
+    def to_json(self, schema):
+        return json.dumps(self.get_schema_columns(schema))
+
+
+def query_columns(pg, schemas, target_tables):
+    # target tables are limited to the ones we map to; import schemas are taken whole
+    sql = """
+    SELECT
+        table_schema,
+        table_name,
+        column_name,
+        data_type,
+        character_maximum_length AS max_length,
+        character_octet_length AS octet_length
+    FROM
+        information_schema.columns
+    WHERE (table_schema = 'public' AND table_name = ANY(%(target_tables)s))
+        OR table_schema = ANY(%(schemas)s)
+    ORDER BY table_schema, table_name, ordinal_position
+    """
+    cursor = pg.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+    cursor.execute(sql, {"schemas": schemas, "target_tables": target_tables})
+    return cursor.fetchall()
+
+
+def get_target_tables_fingerprint(pg, target_tables):
+    # pg_attribute is read directly, which is far cheaper than the information_schema views
+    # it underlies, and the fingerprint changes whenever a target column is added, dropped or retyped
+    sql = """
+    SELECT md5(string_agg(
+        c.relname || '.' || a.attname || ':' || format_type(a.atttypid, a.atttypmod),
+        ',' ORDER BY c.relname, a.attnum
+    )) AS fingerprint
+    FROM pg_catalog.pg_attribute a
+    JOIN pg_catalog.pg_class c ON c.oid = a.attrelid
+    JOIN pg_catalog.pg_namespace n ON n.oid = c.relnamespace
+    WHERE n.nspname = 'public'
+        AND c.relname = ANY(%(target_tables)s)
+        AND a.attnum > 0
+        AND NOT a.attisdropped
+    """
+    cursor = pg.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+    cursor.execute(sql, {"target_tables": target_tables})
+    return cursor.fetchone()["fingerprint"]
+
+
+def load_catalog_snapshot(pg, DB_IMPORT_SCHEMA, cache_directory=None):
+    """
+    Build a snapshot of the target tables' and the import schema's columns.
+
+    Arguments:
+        pg: A psycopg2 connection
+        DB_IMPORT_SCHEMA: The name of the logical group's import schema
+        cache_directory: Optional path of a directory in which to persist the target tables' columns
+
+    Returns: A CatalogSnapshot
+    """
+    target_tables = list(mappings.get_table_map().values())
+
+    if not cache_directory:
+        return CatalogSnapshot(query_columns(pg, [DB_IMPORT_SCHEMA], target_tables))
+
+    fingerprint = get_target_tables_fingerprint(pg, target_tables)
+    cache_file = os.path.join(cache_directory, f"catalog_{fingerprint}.json")
+
+    if os.path.exists(cache_file):
+        with open(cache_file, "r") as file:
+            snapshot = CatalogSnapshot(json.load(file))
+        return snapshot.merge(CatalogSnapshot(query_columns(pg, [DB_IMPORT_SCHEMA], [])))
+
+    snapshot = CatalogSnapshot(query_columns(pg, [DB_IMPORT_SCHEMA], target_tables))
+    os.makedirs(cache_directory, exist_ok=True)
+    with open(cache_file + ".tmp", "w") as file:
+        file.write(snapshot.to_json("public"))
+    os.replace(cache_file + ".tmp", cache_file)
+    return snapshot
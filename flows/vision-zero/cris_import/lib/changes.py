@@ -0,0 +1,36 @@
+from lib.jsonlines import JsonLinesWriter
+
+# This file writes the change log of an import: one JSON line for each VZDB record a logical group inserted or
+# updated, or routed to the conflict resolution system, holding the record's table, its key, what was done with it
+# and the columns which changed. Each logical group of each run writes a file of its own, which is never written
+# to again, so consumers can sync what changed by reading the files they haven't seen yet instead of scanning the
+# crash tables.
+#
+# A conflicting record whose crash already has a change request waiting for review isn't sent as another one, so it
+# isn't logged as a conflict either; it's only counted, as `skipped_existing_change`.
+
+
+class ChangeLogWriter(JsonLinesWriter):
+    def __init__(self, path, logical_group_id):
+        super().__init__(path)
+        self.logical_group_id = logical_group_id
+        self.changes = {"insert": 0, "update": 0, "conflict": 0}
+        self.skipped_existing_changes = 0
+
+    def write(self, table, action, key, changed_columns):
+        self.write_line(
+            {
+                "table": table,
+                "action": action,
+                "key": key,
+                "changed_columns": changed_columns,
+                "logical_group": self.logical_group_id,
+            }
+        )
+        self.changes[action] += 1
+
+    def skip_existing_change(self):
+        self.skipped_existing_changes += 1
+
+    def get_report(self):
+        return {"path": self.get_path(), "changes": self.changes, "skipped_existing_change": self.skipped_existing_changes}
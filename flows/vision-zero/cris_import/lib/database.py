@@ -0,0 +1,174 @@
+import time
+import threading
+from contextlib import contextmanager
+
+import psycopg2
+import psycopg2.pool
+from sshtunnel import SSHTunnelForwarder
+
+from lib.instrumentation import InstrumentedConnection
+
+# This file holds the one SSH tunnel and pool of Postgres connections a CRIS import flow run uses. Tasks borrow
+# a connection for as long as they need one and hand it back, rather than each opening a tunnel and connection
+# of their own, and the whole lot is torn down by the last task of the flow. The time spent on the SSH and
+# Postgres handshakes is tallied so it can be reported along with the run. The connections are instrumented, so
+# the statements each task and helper executes are counted in the run's performance summaries.
+
+
+class TimedConnectionPool(psycopg2.pool.ThreadedConnectionPool):
+    """
+    A thread safe connection pool which times each new connection it has to open.
+    """
+
+    def __init__(self, minconn, maxconn, connection_handshake_seconds, *args, **kwargs):
+        self.connection_handshake_seconds = connection_handshake_seconds
+        super().__init__(minconn, maxconn, *args, **kwargs)
+
+    def _connect(self, key=None):
+        started = time.monotonic()
+        connection = super()._connect(key)
+        self.connection_handshake_seconds.append(time.monotonic() - started)
+        return connection
+
+
+class DatabaseConnectionManager:
+    def __init__(
+        self,
+        bastion_host,
+        ssh_username,
+        ssh_private_key,
+        remote_host,
+        user,
+        password,
+        dbname,
+        sslmode,
+        sslrootcert,
+        max_connections=10,
+        keepalive_seconds=30,
+    ):
+        self.bastion_host = bastion_host
+        self.ssh_username = ssh_username
+        self.ssh_private_key = ssh_private_key
+        self.remote_host = remote_host
+        self.user = user
+        self.password = password
+        self.dbname = dbname
+        self.sslmode = sslmode
+        self.sslrootcert = sslrootcert
+        self.max_connections = max_connections
+        self.keepalive_seconds = keepalive_seconds
+
+        self.lock = threading.Lock()
+        # the pool raises an error when it's exhausted; this makes tasks wait their turn instead
+        self.available_connections = threading.BoundedSemaphore(max_connections)
+        self.ssh_tunnel = None
+        self.pool = None
+        self.tunnel_handshake_seconds = []
+        self.connection_handshake_seconds = []
+        self.health_check_failures = 0
+
+    def start(self):
+        with self.lock:
+            if self.ssh_tunnel and not self.ssh_tunnel.is_active:
+                # the tunnel has dropped out from under us; the pool's connections went with it
+                self.ssh_tunnel.stop()
+                self.ssh_tunnel = None
+                if self.pool:
+                    self.pool.closeall()
+                    self.pool = None
+
+            if not self.ssh_tunnel:
+                started = time.monotonic()
+                self.ssh_tunnel = SSHTunnelForwarder(
+                    (self.bastion_host),
+                    ssh_username=self.ssh_username,
+                    ssh_private_key=self.ssh_private_key,
+                    remote_bind_address=(self.remote_host, 5432),
+                    set_keepalive=self.keepalive_seconds,
+                )
+                self.ssh_tunnel.start()
+                self.tunnel_handshake_seconds.append(time.monotonic() - started)
+
+            if not self.pool:
+                self.pool = TimedConnectionPool(
+                    0,
+                    self.max_connections,
+                    self.connection_handshake_seconds,
+                    host="localhost",
+                    port=self.ssh_tunnel.local_bind_port,
+                    user=self.user,
+                    password=self.password,
+                    dbname=self.dbname,
+                    sslmode=self.sslmode,
+                    sslrootcert=self.sslrootcert,
+                    keepalives=1,
+                    keepalives_idle=self.keepalive_seconds,
+                    keepalives_interval=10,
+                    keepalives_count=5,
+                    connection_factory=InstrumentedConnection,
+                )
+            return self.pool
+
+    def is_healthy(self, pg):
+        if pg.closed:
+            return False
+        try:
+            cursor = pg.cursor()
+            cursor.execute("select 1")
+            cursor.fetchone()
+            pg.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def get_healthy_connection(self):
+        pool = self.start()
+        pg = pool.getconn()
+        if self.is_healthy(pg):
+            return pool, pg
+
+        self.health_check_failures += 1
+        pool.putconn(pg, close=True)
+        # a connection which won't answer is most likely a sign of a broken tunnel, so check it again
+        pool = self.start()
+        return pool, pool.getconn()
+
+    @contextmanager
+    def connection(self):
+        """
+        Borrow a pooled connection which has just been checked to be alive. Anything left uncommitted
+        when the connection is handed back is rolled back by the pool.
+        """
+        self.available_connections.acquire()
+        try:
+            pool, pg = self.get_healthy_connection()
+            try:
+                yield pg
+            finally:
+                if pool is self.pool:
+                    pool.putconn(pg, close=bool(pg.closed))
+                else:
+                    # the pool was replaced while this connection was out, so there's nothing to return it to
+                    pg.close()
+        finally:
+            self.available_connections.release()
+
+    def get_metrics(self):
+        connection_handshake_seconds = self.connection_handshake_seconds
+        return {
+            "tunnel_handshakes": len(self.tunnel_handshake_seconds),
+            "tunnel_handshake_seconds": sum(self.tunnel_handshake_seconds),
+            "connection_handshakes": len(connection_handshake_seconds),
+            "connection_handshake_seconds": sum(connection_handshake_seconds),
+            "max_connection_handshake_seconds": max(connection_handshake_seconds, default=0),
+            "health_check_failures": self.health_check_failures,
+        }
+
+    def close(self):
+        with self.lock:
+            if self.pool:
+                self.pool.closeall()
+                self.pool = None
+            if self.ssh_tunnel:
+                self.ssh_tunnel.stop()
+                self.ssh_tunnel = None
@@ -0,0 +1,29 @@
+from lib.jsonlines import JsonLinesWriter
+
+# This file writes the column level differences found between imported records and the VZDB records they
+# update to a JSON lines file, one line per changed column, so the changes a run makes can be inspected
+# after the fact without the import printing each of them as it goes.
+
+
+class ColumnDiffWriter(JsonLinesWriter):
+    def __init__(self, path):
+        super().__init__(path)
+        self.changes = 0
+        self.records = set()
+
+    def write(self, table, action, key, column, public_value, import_value):
+        self.write_line(
+            {
+                "table": table,
+                "action": action,
+                "key": key,
+                "column": column,
+                "public": public_value,
+                "import": import_value,
+            }
+        )
+        self.changes += 1
+        self.records.add((table, tuple(key.values())))
+
+    def get_report(self):
+        return {"path": self.get_path(), "changed_columns": self.changes, "changed_records": len(self.records)}
@@ -0,0 +1,151 @@
+import os
+import time
+import subprocess
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+# This file decrypts the archives CRIS sends with `7za`. Archives can either be extracted to disk, several at a
+# time, each by its own `7za` process, or left as they are and have their members streamed straight out of them
+# whenever they're read. Streaming skips writing the extract to disk at all, at the cost of decrypting a member
+# each time it's read; the loader reads each CSV once and its header line once more.
+#
+# An extract is described by a dictionary, which is passed between tasks, holding the archive's manifest key and
+# path, the directory it was extracted to (None when it's streamed), the names of its members and a report of
+# what extracting it took.
+
+
+class ArchiveMember:
+    """
+    A file inside of an archive, which is decrypted as it's read.
+    """
+
+    def __init__(self, archive_path, name, password):
+        self.archive_path = archive_path
+        self.name = name
+        self.password = password
+
+    @contextmanager
+    def open(self, check=True):
+        command = ["7za", "e", "-so", f"-p{self.password}", self.archive_path, self.name]
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        try:
+            yield process.stdout
+        finally:
+            process.stdout.close()
+            process.wait()
+        # a member which is closed early, such as after reading its headers, stops 7za with a broken pipe,
+        # so a failure can only be told apart from that once the member has been read to its end
+        if check and process.returncode != 0:
+            raise Exception(f"7za was unable to decrypt {self.name} from {self.archive_path}")
+
+    def __repr__(self):
+        return f"ArchiveMember({self.archive_path}, {self.name})"
+
+
+def list_archive_members(archive_path, password):
+    command = ["7za", "l", "-slt", f"-p{password}", archive_path]
+    output = subprocess.run(command, capture_output=True, text=True, check=True).stdout
+
+    # the technical listing describes the archive itself, then, after a line of dashes, each of its entries
+    _, _, entries = output.partition("----------")
+    members = []
+    for block in entries.strip().split("\n\n"):
+        properties = dict(line.split(" = ", 1) for line in block.splitlines() if " = " in line)
+        if properties.get("Path") and properties.get("Folder") != "+":
+            members.append(properties["Path"])
+    return members
+
+
+def list_directory_members(directory):
+    members = []
+    for root, dirs, files in os.walk(directory):
+        for filename in files:
+            members.append(os.path.relpath(os.path.join(root, filename), directory))
+    return sorted(members)
+
+
+def describe_extracted_archive(archive_key, archive_path, directory, seconds=0):
+    members = list_directory_members(directory)
+    return {
+        "archive_key": archive_key,
+        "archive_path": archive_path,
+        "extract_directory": directory,
+        "members": members,
+        "report": {
+            "seconds": seconds,
+            "bytes_on_disk": sum(os.path.getsize(os.path.join(directory, member)) for member in members),
+            "streamed": False,
+        },
+    }
+
+
+def extract_archive(archive_key, archive_path, destination, password):
+    """
+    Extract an archive to a directory with a `7za` process of its own.
+
+    Returns: An extract dictionary, or None if 7za couldn't extract the archive
+    """
+    started = time.monotonic()
+    os.makedirs(destination, exist_ok=True)
+    command = ["7za", "x", "-y", f"-p{password}", f"-o{destination}", archive_path]
+    result = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    if result.returncode != 0:
+        print(f"7za was unable to extract {archive_path}: {result.stderr.decode(errors='replace')}")
+        return None
+
+    return describe_extracted_archive(archive_key, archive_path, destination, time.monotonic() - started)
+
+
+def describe_streamed_archive(archive_key, archive_path, password):
+    started = time.monotonic()
+    return {
+        "archive_key": archive_key,
+        "archive_path": archive_path,
+        "extract_directory": None,
+        "members": list_archive_members(archive_path, password),
+        "report": {
+            "seconds": time.monotonic() - started,
+            "bytes_on_disk": 0,
+            "streamed": True,
+        },
+    }
+
+
+def extract_archives(archives, password, max_workers):
+    """
+    Extract several archives at the same time, each with a `7za` process of its own.
+
+    Arguments:
+        archives: A list of (archive key, archive path, destination directory) tuples
+        password: The password the archives are encrypted with
+        max_workers: How many archives may be extracted at the same time
+
+    Returns: A list of extract dictionaries, with None in place of any archive which couldn't be extracted
+    """
+    if not archives:
+        return []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [
+            executor.submit(extract_archive, archive_key, archive_path, destination, password)
+            for archive_key, archive_path, destination in archives
+        ]
+        return [future.result() for future in futures]
+
+
+def get_csv_sources(extract, csv_prefix, password):
+    """
+    Find the CSV files of a logical group in an extract.
+
+    Returns: A list of (file name, source) tuples, where each source is either the path of an
+    extracted file or an ArchiveMember
+    """
+    sources = []
+    for member in extract["members"]:
+        filename = os.path.basename(member)
+        if not (filename.endswith(".csv") and filename.startswith(csv_prefix)):
+            continue
+        if extract["extract_directory"]:
+            sources.append((filename, os.path.join(extract["extract_directory"], member)))
+        else:
+            sources.append((filename, ArchiveMember(extract["archive_path"], member, password)))
+    return sources
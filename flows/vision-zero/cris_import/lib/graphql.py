@@ -1,18 +1,200 @@
 import os
+import re
+import time
+import threading
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 GRAPHQL_ENDPOINT = os.environ.get("GRAPHQL_ENDPOINT")
 GRAPHQL_ENDPOINT_KEY = os.environ.get("GRAPHQL_ENDPOINT_KEY")
 
+session = None
+session_lock = threading.Lock()
+
+
+def get_session(retries=5, backoff_factor=1):
+    # one keep-alive session is shared by every request, retrying with backoff when Hasura is briefly unavailable.
+    # a mutation isn't idempotent, so it's only retried when it can't have reached Hasura: when the connection
+    # couldn't be made, or when it was turned away outright. A read which times out may follow a commit, so it isn't
+    # retried here; `ChangeRequestBatcher` sends the requests of a batch which fails that way again one at a time.
+    global session
+    with session_lock:
+        if session is None:
+            retry = Retry(
+                total=retries,
+                connect=retries,
+                read=0,
+                other=0,
+                backoff_factor=backoff_factor,
+                status_forcelist=(429, 503),
+                allowed_methods=frozenset(["POST"]),
+            )
+            session = requests.Session()
+            session.mount("http://", HTTPAdapter(max_retries=retry, pool_maxsize=10))
+            session.mount("https://", HTTPAdapter(max_retries=retry, pool_maxsize=10))
+        return session
+
+
 # 🙏🏻 https://github.com/cityofaustin/atd-moped/blob/main/moped-toolbox/amd_milestones_backfill/utils.py#L18
 
 def make_hasura_request(*, query, variables={}, endpoint=GRAPHQL_ENDPOINT, admin_secret=GRAPHQL_ENDPOINT_KEY):
     headers = {"X-Hasura-Admin-Secret": admin_secret}
     payload = {"query": query, "variables": variables}
-    res = requests.post(endpoint, json=payload, headers=headers)
+    res = get_session().post(endpoint, json=payload, headers=headers)
     res.raise_for_status()
     data = res.json()
     try:
         return data["data"]
     except KeyError:
         raise ValueError(data)
+
+
+def scan_value(text, start):
+    """
+    Find where the GraphQL value starting at `start` ends, stepping over nested objects, lists and strings,
+    as a string such as a record's escaped JSON may well hold braces of its own.
+    """
+    depth = 0
+    index = start
+    while index < len(text):
+        character = text[index]
+        if character == '"':
+            index += 1
+            while index < len(text) and text[index] != '"':
+                index += 2 if text[index] == "\\" else 1
+        elif character in "{[(":
+            depth += 1
+        elif character in "}])":
+            if depth == 0:
+                return index
+            depth -= 1
+            if depth == 0:
+                return index + 1
+        elif depth == 0 and (character.isspace() or character == ","):
+            return index
+        index += 1
+    return index
+
+
+def parse_insert_mutation(mutation):
+    """
+    Split a single-field insert mutation document, such as one made by `insert_crash_change_template()`, into its
+    field's name and its arguments, in the order they're given.
+
+    Returns: A tuple of the field's name and a list of (name, value) tuples, or None if it isn't of that shape
+    """
+    body = mutation[mutation.index("{") + 1 : mutation.rindex("}")].strip()
+    match = re.match(r"(\w+)\s*\(", body)
+    if not match:
+        return None
+    arguments = []
+    index = match.end()
+    while True:
+        while index < len(body) and (body[index].isspace() or body[index] == ","):
+            index += 1
+        if index >= len(body) or body[index] == ")":
+            break
+        name = re.match(r"(\w+)\s*:\s*", body[index:])
+        if not name:
+            return None
+        index += name.end()
+        end = scan_value(body, index)
+        arguments.append((name.group(1), body[index:end]))
+        index = end
+    return match.group(1), arguments
+
+
+def combine_mutations(mutations):
+    """
+    Combine a list of single-row insert mutation documents, such as those made by `insert_crash_change_template()`,
+    into one bulk insert of all of their rows, which Hasura runs as a single statement in a single transaction.
+    Mutations which can't be combined that way, because they aren't inserts into the same table with the same
+    arguments, are aliased to sit side by side in one document instead.
+    """
+    parsed = [parse_insert_mutation(mutation) for mutation in mutations]
+    if all(parsed):
+        fields = {re.sub(r"_one$", "", field) for field, _ in parsed}
+        others = {tuple((name, value) for name, value in arguments if name not in ("object", "objects")) for _, arguments in parsed}
+        rows = []
+        for _, arguments in parsed:
+            for name, value in arguments:
+                if name in ("object", "objects"):
+                    # a list of rows is spliced in, without its brackets
+                    rows.append(value[1:-1].strip() if value.startswith("[") else value)
+        if len(fields) == 1 and len(others) == 1 and len(rows) == len(mutations):
+            arguments = ", ".join([f"objects: [{', '.join(rows)}]"] + [f"{name}: {value}" for name, value in others.pop()])
+            return f"mutation insertChangeMutations {{\n{fields.pop()}({arguments}) {{\naffected_rows\n}}\n}}"
+
+    fields = []
+    for index, mutation in enumerate(mutations):
+        # the field is everything inside the outermost braces of the document
+        field = mutation[mutation.index("{") + 1 : mutation.rindex("}")].strip()
+        fields.append(f"change_{index}: {field}")
+    return "mutation insertChangeMutations {\n" + "\n".join(fields) + "\n}"
+
+
+class ChangeRequestBatcher:
+    """
+    Collects change request mutations and submits them to Hasura in batches, each as one bulk insert. If Hasura
+    rejects a batch, which rolls all of it back, or the batch's request fails, such as by timing out, its mutations
+    are sent again one at a time, so a single bad record, or a single slow response, doesn't lose the rest. The
+    change request template upserts on the changes table's unique constraint, so a change request which made it
+    in the first time isn't made twice.
+    """
+
+    def __init__(self, batch_size=50):
+        self.batch_size = batch_size
+        self.pending = []
+        self.batches = []
+        self.failures = []
+
+    def add(self, mutation, record_id):
+        self.pending.append((mutation, record_id))
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        batch, self.pending = self.pending, []
+
+        started = time.monotonic()
+        failures = []
+        try:
+            make_hasura_request(query=combine_mutations([mutation for mutation, _ in batch]))
+        except (requests.RequestException, ValueError):
+            for mutation, record_id in batch:
+                try:
+                    make_hasura_request(query=mutation)
+                except (requests.RequestException, ValueError) as error:
+                    failures.append({"record_id": record_id, "error": str(error)})
+
+        seconds = time.monotonic() - started
+        self.failures.extend(failures)
+        self.batches.append(
+            {
+                "submitted": len(batch),
+                "failed": len(failures),
+                "seconds": seconds,
+                "per_second": len(batch) / seconds if seconds else None,
+            }
+        )
+        print(f"Submitted a batch of {len(batch)} change requests in {seconds:.2f}s, {len(failures)} failed")
+
+    def raise_for_failures(self):
+        # a change request which wasn't made can't be made later, as the records it was for are taken as aligned
+        if self.failures:
+            raise Exception(f"{len(self.failures)} change requests could not be submitted: {self.failures}")
+
+    def get_report(self):
+        seconds = sum(batch["seconds"] for batch in self.batches)
+        submitted = sum(batch["submitted"] for batch in self.batches)
+        return {
+            "batches": len(self.batches),
+            "submitted": submitted,
+            "failed": len(self.failures),
+            "seconds": seconds,
+            "per_second": submitted / seconds if seconds else None,
+            "failures": self.failures,
+        }
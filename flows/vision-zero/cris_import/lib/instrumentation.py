@@ -0,0 +1,344 @@
+import os
+import json
+import time
+import datetime
+import resource
+import functools
+import threading
+from contextlib import contextmanager
+
+import psycopg2.extensions
+
+# This file measures where a CRIS import spends its time. Each task, and each of the helpers in `lib/sql.py` which
+# do the heavy lifting, is measured for its wall time, the round trips it made to the database, the rows those
+# affected or returned, the bytes it sent or received with COPY, and how much the process's resident set grew while it
+# ran. Logical groups are processed side by side, so a task's growth counts what the tasks running alongside it
+# allocated too; the process's peak RSS is only reported for the run as a whole.
+#
+# Round trips, rows and bytes are counted by the connections themselves: the pool hands out InstrumentedConnections,
+# whose cursors count each statement they execute, and each batch fetched from a named cursor, against every
+# measurement open on the thread which executes it.
+# A measurement can be carried to another thread, such as the workers which apply shards, with `attach()`.
+#
+# Measurements are collected for the whole flow run and for each logical group, and written out as JSON summaries
+# at its end, so runs can be compared to see which stage dominates an extract, and to catch regressions.
+
+COUNTERS = ["round_trips", "rows", "bytes"]
+
+local = threading.local()
+
+
+class Measurement:
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.seconds = 0.0
+        self.counters = {counter: 0 for counter in COUNTERS}
+        self.rss_change_mb = 0.0
+        self.helpers = {}
+
+    def count(self, **counts):
+        with self.lock:
+            for counter, value in counts.items():
+                self.counters[counter] += value
+
+    def add(self, other):
+        # folds a helper's measurement into this one's tally of that helper
+        with self.lock:
+            helper = self.helpers.setdefault(other.name, {"calls": 0, "seconds": 0.0, **{counter: 0 for counter in COUNTERS}})
+            helper["calls"] += other.calls
+            helper["seconds"] = round(helper["seconds"] + other.seconds, 3)
+            for counter in COUNTERS:
+                helper[counter] += other.counters[counter]
+
+    def to_dict(self):
+        return {
+            "calls": self.calls,
+            "seconds": round(self.seconds, 3),
+            **self.counters,
+            "rss_change_mb": round(self.rss_change_mb, 1),
+            "helpers": self.helpers,
+        }
+
+
+def get_peak_rss_mb():
+    # linux reports the high water mark of the resident set in kilobytes
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def get_rss_mb():
+    # the second field of statm is the current resident set, in pages
+    with open("/proc/self/statm") as statm:
+        return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024 / 1024
+
+
+def get_open_measurements():
+    if not hasattr(local, "measurements"):
+        local.measurements = []
+    return local.measurements
+
+
+def current():
+    measurements = get_open_measurements()
+    return measurements[0] if measurements else None
+
+
+def count(**counts):
+    for measurement in get_open_measurements():
+        measurement.count(**counts)
+
+
+@contextmanager
+def attach(measurement):
+    """
+    Count what's done on this thread against a measurement opened on another one.
+    """
+    measurements = get_open_measurements()
+    if measurement is None:
+        yield
+        return
+    measurements.append(measurement)
+    try:
+        yield
+    finally:
+        measurements.remove(measurement)
+
+
+@contextmanager
+def measure(name):
+    measurement = Measurement(name)
+    measurements = get_open_measurements()
+    measurements.append(measurement)
+    started = time.monotonic()
+    try:
+        yield measurement
+    finally:
+        measurement.calls += 1
+        measurement.seconds += time.monotonic() - started
+        measurements.remove(measurement)
+
+
+class Registry:
+    """
+    The measurements of a flow run's tasks, by logical group for the tasks which handle one.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.started_at = datetime.datetime.now()
+            self.tasks = {}
+            self.groups = {}
+
+    def record(self, measurement, logical_group_id=None):
+        with self.lock:
+            tasks = self.groups.setdefault(logical_group_id, {}) if logical_group_id else self.tasks
+            if measurement.name in tasks:
+                # a task which is retried adds up the measurements of each of its attempts
+                previous = tasks[measurement.name]
+                measurement.calls += previous["calls"]
+                measurement.seconds += previous["seconds"]
+                for counter in COUNTERS:
+                    measurement.counters[counter] += previous[counter]
+                measurement.rss_change_mb += previous["rss_change_mb"]
+                for name, helper in previous["helpers"].items():
+                    measurement.helpers.setdefault(name, {"calls": 0, "seconds": 0.0, **{counter: 0 for counter in COUNTERS}})
+                    for key, value in helper.items():
+                        measurement.helpers[name][key] = round(measurement.helpers[name][key] + value, 3)
+            tasks[measurement.name] = measurement.to_dict()
+
+    def summarize_group(self, logical_group_id):
+        tasks = self.groups.get(logical_group_id, {})
+        return {
+            "logical_group_id": logical_group_id,
+            "seconds": round(sum(task["seconds"] for task in tasks.values()), 3),
+            "tasks": tasks,
+        }
+
+    def write_summaries(self, directory):
+        """
+        Write a JSON summary for the flow run and one for each of its logical groups.
+
+        Returns: A list of the paths written
+        """
+        run_timestamp = self.started_at.strftime("%Y%m%d%H%M%S")
+        os.makedirs(directory, exist_ok=True)
+        with self.lock:
+            groups = {logical_group_id: self.summarize_group(logical_group_id) for logical_group_id in self.groups}
+            run = {
+                "started_at": self.started_at.isoformat(),
+                "finished_at": datetime.datetime.now().isoformat(),
+                "peak_rss_mb": get_peak_rss_mb(),
+                "tasks": self.tasks,
+                "logical_groups": groups,
+            }
+
+        paths = []
+        for logical_group_id, summary in groups.items():
+            paths.append(os.path.join(directory, f"{logical_group_id}_{run_timestamp}.json"))
+            with open(paths[-1], "w") as file:
+                json.dump(summary, file, indent=2)
+        paths.append(os.path.join(directory, f"run_{run_timestamp}.json"))
+        with open(paths[-1], "w") as file:
+            json.dump(run, file, indent=2)
+        return paths
+
+
+registry = Registry()
+
+
+def get_logical_group_id(arguments):
+    # a task handling a logical group is given its state dictionary, under whichever name the task gives it
+    for argument in arguments:
+        if isinstance(argument, dict) and argument.get("logical_group_id"):
+            return argument["logical_group_id"]
+    return None
+
+
+def measured_task(function):
+    """
+    Measure each run of a task, and record it against the logical group it was given, if it was given one.
+    """
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        logical_group_id = get_logical_group_id(list(args) + list(kwargs.values()))
+        measurement = None
+        # the resident set is read around tasks only, as helpers are called far too often for it
+        rss_mb = get_rss_mb()
+        try:
+            with measure(function.__name__) as measurement:
+                return function(*args, **kwargs)
+        finally:
+            # a task which fails is recorded too, as the time it took is as telling; unless measuring it failed
+            if measurement is not None:
+                measurement.rss_change_mb = get_rss_mb() - rss_mb
+                registry.record(measurement, logical_group_id)
+
+    return wrapper
+
+
+def measured_helper(function):
+    """
+    Measure each call of a helper and tally it against the measurements open when it's called.
+    """
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        outer = list(get_open_measurements())
+        if not outer:
+            return function(*args, **kwargs)
+        with measure(function.__name__) as measurement:
+            result = function(*args, **kwargs)
+        for open_measurement in outer:
+            open_measurement.add(measurement)
+        return result
+
+    return wrapper
+
+
+class CountingFile:
+    """
+    A file-like wrapper which counts the bytes COPY reads from or writes to a file.
+    """
+
+    def __init__(self, file):
+        self.file = file
+
+    def read(self, size=-1):
+        data = self.file.read(size)
+        count(bytes=len(data))
+        return data
+
+    def readline(self, size=-1):
+        data = self.file.readline(size)
+        count(bytes=len(data))
+        return data
+
+    def write(self, data):
+        count(bytes=len(data))
+        return self.file.write(data)
+
+
+counting_cursor_classes = {}
+
+
+def get_counting_cursor_class(cursor_class):
+    # a counting subclass is made for each kind of cursor asked for, such as RealDictCursor, the first time it's needed
+    if cursor_class not in counting_cursor_classes:
+
+        class CountingCursor(cursor_class):
+            def execute(self, query, vars=None):
+                try:
+                    return super().execute(query, vars)
+                finally:
+                    count(round_trips=1, rows=max(self.rowcount, 0))
+
+            def executemany(self, query, vars_list):
+                try:
+                    return super().executemany(query, vars_list)
+                finally:
+                    count(round_trips=1, rows=max(self.rowcount, 0))
+
+            def copy_expert(self, sql, file, size=8192):
+                try:
+                    return super().copy_expert(sql, CountingFile(file), size)
+                finally:
+                    count(round_trips=1, rows=max(self.rowcount, 0))
+
+            # a named cursor leaves its result set on the server, so each fetch from it is a round trip of its own,
+            # and its rows are counted as they're fetched, rather than when it's executed
+            def fetchone(self):
+                row = super().fetchone()
+                if self.name:
+                    count(round_trips=1, rows=int(row is not None))
+                return row
+
+            def fetchmany(self, size=None):
+                rows = super().fetchmany(self.arraysize if size is None else size)
+                if self.name:
+                    count(round_trips=1, rows=len(rows))
+                return rows
+
+            def fetchall(self):
+                rows = super().fetchall()
+                if self.name:
+                    count(round_trips=1, rows=len(rows))
+                return rows
+
+            def __iter__(self):
+                return self.iterate_named() if self.name else super().__iter__()
+
+            def iterate_named(self):
+                # iterating a named cursor fetches `itersize` rows at a time, as psycopg2 does
+                while True:
+                    rows = self.fetchmany(self.itersize)
+                    if not rows:
+                        return
+                    yield from rows
+
+        counting_cursor_classes[cursor_class] = CountingCursor
+    return counting_cursor_classes[cursor_class]
+
+
+class InstrumentedConnection(psycopg2.extensions.connection):
+    """
+    A connection whose cursors count the statements they execute, and whose commits and rollbacks are counted too.
+    """
+
+    def cursor(self, *args, **kwargs):
+        cursor_class = kwargs.get("cursor_factory") or self.cursor_factory or psycopg2.extensions.cursor
+        kwargs["cursor_factory"] = get_counting_cursor_class(cursor_class)
+        return super().cursor(*args, **kwargs)
+
+    def commit(self):
+        count(round_trips=1)
+        return super().commit()
+
+    def rollback(self):
+        count(round_trips=1)
+        return super().rollback()
@@ -0,0 +1,36 @@
+import os
+import json
+import threading
+
+# This file writes the JSON lines files a CRIS import leaves behind for each logical group, such as its column
+# diffs, its change log and its rejected statements. A file is only created once there's something to write to
+# it, and lines may be written from more than one thread, as the shard workers of a group share its files.
+
+
+class JsonLinesWriter:
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write_line(self, line):
+        with self.lock:
+            if not self.file:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                self.file = open(self.path, "w")
+            # values which aren't native to JSON, such as dates, are written as their text
+            self.file.write(json.dumps(line, default=str) + "\n")
+
+    def get_path(self):
+        return self.path if self.file else None
+
+    def close(self):
+        with self.lock:
+            if self.file:
+                self.file.close()
@@ -0,0 +1,141 @@
+import os
+import re
+import io
+import csv
+
+import lib.sql as util
+from lib.extraction import ArchiveMember
+
+# This file streams the CSV files found in a CRIS extract into the tables of an import schema using
+# PostgreSQL's `COPY ... FROM STDIN`. The files are read in chunks and handed to the database over
+# the connection they're given, so they're never staged anywhere else along the way, and there is no
+# separate loader process to start or tunnel to open for each of them. A CSV file can be read from an
+# extract on disk or streamed straight out of its archive as it's decrypted.
+#
+# Optionally, the trailing carriage returns and newlines CRIS leaves on some values can be trimmed
+# while a file streams through, so the import tables never need to be cleaned up in place.
+
+COPY_BUFFER_SIZE = 1024 * 1024
+
+# narrative fields can run well past the csv module's default limit of 128KB
+csv.field_size_limit(2**31 - 1)
+
+
+class CountingReader:
+    """
+    A read-only file-like wrapper which keeps a tally of how many bytes have been read through it.
+    """
+
+    def __init__(self, file):
+        self.file = file
+        self.bytes_read = 0
+
+    def read(self, size=-1):
+        data = self.file.read(size)
+        self.bytes_read += len(data)
+        return data
+
+    def readline(self, size=-1):
+        data = self.file.readline(size)
+        self.bytes_read += len(data)
+        return data
+
+
+class TrimmedCsvReader:
+    """
+    A read-only file-like object which parses a CSV file and hands it out again, re-serialized,
+    with trailing carriage returns and newlines removed from every value. It keeps a tally of the
+    values it changed, by column, and of the bytes it has handed out.
+    """
+
+    def __init__(self, file):
+        self.rows = csv.reader(file)
+        self.headers = None
+        self.buffer = io.StringIO()
+        self.writer = csv.writer(self.buffer, lineterminator="\n")
+        self.pending = b""
+        self.exhausted = False
+        self.bytes_read = 0
+        self.trimmed_values = {}
+
+    def fill(self, size):
+        while not self.exhausted and self.buffer.tell() < size:
+            row = next(self.rows, None)
+            if row is None:
+                self.exhausted = True
+                break
+            if self.headers is None:
+                self.headers = row
+                self.trimmed_values = {header: 0 for header in row}
+            else:
+                for index, value in enumerate(row):
+                    trimmed = value.rstrip("\r\n")
+                    if trimmed != value:
+                        row[index] = trimmed
+                        self.trimmed_values[self.headers[index]] += 1
+            self.writer.writerow(row)
+        self.pending += self.buffer.getvalue().encode("utf-8", "surrogateescape")
+        self.buffer.seek(0)
+        self.buffer.truncate()
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = float("inf")
+        if len(self.pending) < size:
+            self.fill(size)
+        data = self.pending[:size] if size != float("inf") else self.pending
+        self.pending = self.pending[len(data):]
+        self.bytes_read += len(data)
+        return data
+
+
+def get_table_name_from_filename(filename):
+    # Extract the table name from the filename. They are named `crash`, `unit`, `person`, `primaryperson`, & `charges`.
+    return re.search("extract_[\d_]+(.*)_[\d].*\.csv", filename).group(1)
+
+
+def open_csv(source, check=True):
+    # a source is either the path of an extracted file or an ArchiveMember; either way, it's opened as bytes
+    if isinstance(source, ArchiveMember):
+        return source.open(check)
+    return open(source, "rb")
+
+
+def read_headers(source):
+    with open_csv(source, check=False) as file:
+        headers_line = file.readline().decode("utf-8").strip()
+    return headers_line.split(",")
+
+
+def copy_csv_into_table(pg, DB_IMPORT_SCHEMA, table, source, trim_carriage_returns=False, unlogged=False, freeze=False):
+    """
+    (Re)create an import table with a `character varying` column for each CSV header and stream the CSV into it.
+    The table is created and loaded in one transaction, so it can be loaded with `COPY ... FREEZE`.
+
+    Returns: A dictionary holding the number of rows and bytes which were loaded and,
+    if values were trimmed on the way in, the number of values trimmed per column
+    """
+    headers = read_headers(source)
+
+    cursor = pg.cursor()
+    cursor.execute(util.form_import_table_statement(DB_IMPORT_SCHEMA, table, headers, unlogged))
+
+    with open_csv(source) as file:
+        if trim_carriage_returns:
+            reader = TrimmedCsvReader(io.TextIOWrapper(file, encoding="utf-8", errors="surrogateescape", newline=""))
+        else:
+            reader = CountingReader(file)
+
+        cursor.copy_expert(
+            util.form_copy_statement(DB_IMPORT_SCHEMA, table, headers, freeze),
+            reader,
+            size=COPY_BUFFER_SIZE,
+        )
+        rows = cursor.rowcount
+
+    pg.commit()
+
+    load_report = {"rows": rows, "bytes": reader.bytes_read}
+    if trim_carriage_returns:
+        load_report["trimmed_values"] = {column: count for column, count in reader.trimmed_values.items() if count}
+    return load_report
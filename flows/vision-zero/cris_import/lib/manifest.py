@@ -0,0 +1,125 @@
+import os
+import json
+import hashlib
+import datetime
+import threading
+
+# This file keeps a manifest, on local disk, of the CRIS archives the import has seen and of how far each of
+# them has made it through the flow. Archives are identified by a checksum and the size of the zip, so the
+# same extract sent twice, or downloaded again by a retried run, is recognized whatever its file is named.
+#
+# An archive moves through the stages below in order. A stage is recorded once it's complete, so a later
+# run can pick an archive up after the last stage it completed, and leave alone archives which are done.
+#
+# Within an archive, each logical group keeps checkpoints of the steps it has completed against its import
+# schema, such as loading and typing its tables, and of how far it got applying each table, so a rerun can
+# pick the group up where it left off for as long as that schema is still there.
+
+STAGES = ["downloaded", "extracted", "loaded", "applied", "archived"]
+
+CHECKSUM_BLOCK_SIZE = 1024 * 1024
+
+
+def get_archive_key(path):
+    checksum = hashlib.sha256()
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(CHECKSUM_BLOCK_SIZE), b""):
+            checksum.update(block)
+    return f"{checksum.hexdigest()}:{os.path.getsize(path)}"
+
+
+class ArchiveManifest:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def read(self):
+        if not os.path.exists(self.path):
+            return {}
+        with open(self.path, "r") as file:
+            return json.load(file)
+
+    def write(self, archives):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path + ".tmp", "w") as file:
+            json.dump(archives, file, indent=2, sort_keys=True)
+        os.replace(self.path + ".tmp", self.path)
+
+    def get_archive(self, key):
+        with self.lock:
+            return self.read().get(key)
+
+    def has_reached(self, key, stage):
+        archive = self.get_archive(key)
+        if not archive or not archive.get("stage"):
+            return False
+        return STAGES.index(archive["stage"]) >= STAGES.index(stage)
+
+    def record_stage(self, key, stage, **details):
+        """
+        Record that an archive has completed a stage, along with any details a later stage will need.
+        An archive never moves back to an earlier stage.
+        """
+        with self.lock:
+            archives = self.read()
+            archive = archives.setdefault(key, {"stage": None, "logical_groups": {}})
+            if not archive["stage"] or STAGES.index(stage) > STAGES.index(archive["stage"]):
+                archive["stage"] = stage
+            archive[f"{stage}_at"] = datetime.datetime.now().isoformat()
+            archive.update(details)
+            self.write(archives)
+
+    def record_details(self, key, **details):
+        """
+        Record details of an archive which don't move it to another stage, such as work done
+        for a later stage ahead of time.
+        """
+        with self.lock:
+            archives = self.read()
+            archive = archives.setdefault(key, {"stage": None, "logical_groups": {}})
+            archive.update(details)
+            self.write(archives)
+
+    def record_logical_groups(self, key, group_ids):
+        with self.lock:
+            archives = self.read()
+            for group_id in group_ids:
+                archives[key]["logical_groups"].setdefault(group_id, None)
+            self.write(archives)
+
+    def get_logical_group_stage(self, key, group_id):
+        archive = self.get_archive(key) or {}
+        return archive.get("logical_groups", {}).get(group_id)
+
+    def get_logical_group_checkpoints(self, key, group_id):
+        archive = self.get_archive(key) or {}
+        return archive.get("checkpoints", {}).get(group_id, {})
+
+    def record_logical_group_checkpoint(self, key, group_id, step, **details):
+        """
+        Record that a logical group has completed a step, along with anything a rerun needs to skip it.
+        """
+        with self.lock:
+            archives = self.read()
+            checkpoints = archives[key].setdefault("checkpoints", {}).setdefault(group_id, {})
+            checkpoints[step] = dict(details, at=datetime.datetime.now().isoformat())
+            self.write(archives)
+
+    def clear_logical_group_checkpoints(self, key, group_id):
+        with self.lock:
+            archives = self.read()
+            if key in archives and archives[key].get("checkpoints", {}).pop(group_id, None) is not None:
+                self.write(archives)
+
+    def record_logical_group_stage(self, key, group_id, stage):
+        """
+        Record that a logical group of an archive has completed a stage. Once every logical group
+        of the archive has completed it, so has the archive.
+        """
+        with self.lock:
+            archives = self.read()
+            groups = archives[key]["logical_groups"]
+            groups[group_id] = stage
+            self.write(archives)
+        if all(STAGES.index(group_stage or STAGES[0]) >= STAGES.index(stage) for group_stage in groups.values()):
+            self.record_stage(key, stage)
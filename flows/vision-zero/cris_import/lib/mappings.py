@@ -16,6 +16,15 @@ def get_table_map():
     }
 
 
+def get_apply_phases():
+    # the tables of each phase are applied side by side, once every table of the phases before it has
+    # been applied. The other tables reference crashes, so crashes are applied first.
+    return [
+        ["crash"],
+        ["unit", "person", "primaryperson"],
+    ]
+
+
 def get_key_columns():
     return {
         "atd_txdot_crashes": ["crash_id"],
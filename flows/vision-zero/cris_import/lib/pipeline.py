@@ -0,0 +1,167 @@
+import time
+import queue
+import threading
+import traceback
+
+# This file runs a sequence of items, such as the logical groups of a CRIS import, through a sequence of stages,
+# each of which has worker threads of its own. Stages are connected by bounded queues, so an item can start on a
+# stage as soon as it's done with the one before, while other items are still busy with later stages, and a
+# fast stage can only get so far ahead of a slow one.
+#
+# A stage can be marked as ordered, in which case items are handed to it strictly in the sequence they were
+# given in, skipping any which failed along the way. An item which fails at a stage is dropped from the
+# pipeline; the rest carry on.
+
+STOP = object()
+
+
+class Stage:
+    def __init__(self, name, function, workers=1, ordered=False):
+        self.name = name
+        self.function = function
+        self.workers = workers
+        self.ordered = ordered
+
+
+class OrderedHandoff:
+    """
+    Holds items which arrive out of sequence until every item ahead of them has arrived or been dropped.
+
+    The destination queue is bounded, so handing items on may block. It's done without holding the lock which
+    guards the held items, so items can still arrive, or be dropped, while it waits; only one thread hands items
+    on at a time, which keeps them in sequence, and it hands on whatever became ready while it was waiting too.
+    """
+
+    def __init__(self, destination):
+        self.destination = destination
+        self.lock = threading.Lock()
+        self.delivering = threading.Lock()
+        self.pending = {}
+        self.dropped = set()
+        self.next_sequence = 0
+
+    def put(self, sequence, item):
+        with self.lock:
+            self.pending[sequence] = item
+        self.release()
+
+    def drop(self, sequence):
+        with self.lock:
+            self.dropped.add(sequence)
+        self.release()
+
+    def take_next(self):
+        # the next item in sequence, if it has arrived, skipping any which were dropped
+        with self.lock:
+            while self.next_sequence in self.dropped:
+                self.dropped.remove(self.next_sequence)
+                self.next_sequence += 1
+            if self.next_sequence not in self.pending:
+                return None
+            entry = (self.next_sequence, self.pending.pop(self.next_sequence))
+            self.next_sequence += 1
+            return entry
+
+    def is_ready(self):
+        with self.lock:
+            return self.next_sequence in self.pending or self.next_sequence in self.dropped
+
+    def release(self):
+        # a thread which finds another one handing items on leaves its item to it
+        while self.delivering.acquire(blocking=False):
+            try:
+                entry = self.take_next()
+                while entry is not None:
+                    self.destination.put(entry)
+                    entry = self.take_next()
+            finally:
+                self.delivering.release()
+            # an item may have become ready after the last look, while another thread found this one still delivering
+            if not self.is_ready():
+                return
+
+
+class Pipeline:
+    def __init__(self, stages, queue_size, on_drop=None):
+        """
+        Arguments:
+            stages: A list of Stages, in the order items go through them
+            queue_size: How many items may wait between two stages
+            on_drop: A function called with an item which failed at a stage, and won't go on to the ones after it
+        """
+        self.stages = stages
+        self.queues = [queue.Queue(maxsize=queue_size) for _ in stages] + [queue.Queue()]
+        self.handoffs = [OrderedHandoff(self.queues[index]) if stage.ordered else None for index, stage in enumerate(stages)]
+        self.on_drop = on_drop
+        self.failures = []
+        self.metrics = {stage.name: {"items": 0, "seconds": 0.0, "waiting_seconds": 0.0} for stage in stages}
+        self.lock = threading.Lock()
+
+    def hand_to(self, index, sequence, item):
+        if index < len(self.stages) and self.handoffs[index]:
+            self.handoffs[index].put(sequence, item)
+        else:
+            self.queues[index].put((sequence, item))
+
+    def drop(self, index, sequence, item, error):
+        with self.lock:
+            self.failures.append({"stage": self.stages[index].name, "item": item, "error": error})
+        # the item is let go of before the items behind it are handed on, as handing them on may have to wait
+        # for workers which are themselves waiting on it
+        if self.on_drop:
+            self.on_drop(item)
+        for later_index in range(index + 1, len(self.stages)):
+            if self.handoffs[later_index]:
+                self.handoffs[later_index].drop(sequence)
+
+    def work(self, index):
+        stage = self.stages[index]
+        while True:
+            waited_from = time.monotonic()
+            entry = self.queues[index].get()
+            if entry is STOP:
+                return
+            sequence, item = entry
+
+            started = time.monotonic()
+            try:
+                result = stage.function(item)
+            except Exception:
+                self.drop(index, sequence, item, traceback.format_exc())
+                result = None
+            else:
+                self.hand_to(index + 1, sequence, result)
+            finished = time.monotonic()
+
+            with self.lock:
+                self.metrics[stage.name]["items"] += 1
+                self.metrics[stage.name]["seconds"] += finished - started
+                self.metrics[stage.name]["waiting_seconds"] += started - waited_from
+
+    def run(self, items):
+        """
+        Run every item through every stage.
+
+        Returns: A list of the items which made it through all of the stages, as the last stage returned them, in sequence
+        """
+        workers = []
+        for index, stage in enumerate(self.stages):
+            stage_workers = [threading.Thread(target=self.work, args=(index,), name=f"{stage.name}-{number}") for number in range(stage.workers)]
+            for worker in stage_workers:
+                worker.start()
+            workers.append(stage_workers)
+
+        for sequence, item in enumerate(items):
+            self.hand_to(0, sequence, item)
+
+        # once a stage's workers are done, everything they'll ever hand on has been handed on
+        for index, stage_workers in enumerate(workers):
+            for _ in stage_workers:
+                self.queues[index].put(STOP)
+            for worker in stage_workers:
+                worker.join()
+
+        finished = []
+        while not self.queues[-1].empty():
+            finished.append(self.queues[-1].get())
+        return [item for sequence, item in sorted(finished, key=lambda entry: entry[0])]
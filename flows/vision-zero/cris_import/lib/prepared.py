@@ -0,0 +1,42 @@
+import psycopg2.extensions
+
+# This file keeps track of the server-side prepared statements a connection holds while the records of
+# an import table are aligned one at a time. Each statement is parsed and planned by Postgres the first
+# time it's used, and after that only the values of the record's keys are sent along to execute it.
+#
+# Prepared statements belong to the session which prepared them, not to a transaction, so they outlive
+# commits and rollbacks alike. They're deallocated when the table is done, as the connection goes back
+# to the pool to be used by other tasks.
+
+
+class PreparedStatements:
+    def __init__(self, pg, name_prefix):
+        self.pg = pg
+        self.name_prefix = name_prefix
+        self.names = {}
+
+    def prepare(self, key, sql, parameter_count):
+        """
+        Prepare a statement, written with `$1`, `$2`, ... placeholders, unless it already has been.
+
+        Returns: The SQL which executes the statement, with a psycopg2 placeholder for each parameter
+        """
+        if key not in self.names:
+            name = f"{self.name_prefix}_{len(self.names)}"
+            cursor = self.pg.cursor()
+            cursor.execute(f"prepare {name} as {sql}")
+            self.names[key] = name
+        placeholders = ", ".join(["%s"] * parameter_count)
+        return f"execute {self.names[key]} ({placeholders})"
+
+    def deallocate(self):
+        if self.pg.closed:
+            return
+        # a deallocation can't be run in a transaction which has already failed
+        if self.pg.get_transaction_status() == psycopg2.extensions.TRANSACTION_STATUS_INERROR:
+            self.pg.rollback()
+        cursor = self.pg.cursor()
+        for name in self.names.values():
+            cursor.execute(f"deallocate {name}")
+        self.pg.commit()
+        self.names = {}
@@ -0,0 +1,42 @@
+# This file holds the compact form imported records take while they're streamed out of an import table.
+# Every record of a table shares one mapping of column names to positions, and holds nothing but a tuple
+# of its values, so a large extract costs little more memory than the values themselves. A record still
+# behaves like the dictionaries the SQL helpers and the change request template expect of it.
+
+
+class ImportedRecord:
+    __slots__ = ("column_positions", "values")
+
+    def __init__(self, column_positions, values):
+        self.column_positions = column_positions
+        self.values = values
+
+    def __getitem__(self, column):
+        return self.values[self.column_positions[column]]
+
+    def __contains__(self, column):
+        return column in self.column_positions
+
+    def __iter__(self):
+        return iter(self.column_positions)
+
+    def __len__(self):
+        return len(self.values)
+
+    def get(self, column, default=None):
+        if column in self.column_positions:
+            return self[column]
+        return default
+
+    def keys(self):
+        return self.column_positions.keys()
+
+    def items(self):
+        return zip(self.column_positions.keys(), self.values)
+
+    def __repr__(self):
+        return f"ImportedRecord({dict(self.items())})"
+
+
+def get_column_positions(description):
+    return {column.name: position for position, column in enumerate(description)}
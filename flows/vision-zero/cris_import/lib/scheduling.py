@@ -0,0 +1,80 @@
+import threading
+
+# This file keeps logical groups which are processed at the same time from racing each other on the same
+# records. Every stage of a logical group may run alongside any other group's stages, except for aligning
+# records with the VZDB: a group may only align once each group ahead of it, in the order of their group
+# ids, has either finished or turned out to hold a crash_id range which doesn't overlap its own.
+#
+# The coordination is done with threading primitives, so it's meant for the thread based executor the
+# flow is configured with. Groups are identified by their position in the list of logical groups, which
+# is also the `map_index` prefect gives the mapped task runs of each group. A group waits in one of the
+# executor's threads, so the wait is given a timeout: groups which haven't been loaded yet may be waiting on
+# a thread themselves, and a wait without one could hold every thread there is.
+
+
+class LogicalGroupSequencer:
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.crash_id_ranges = {}
+        self.finished_groups = set()
+
+    def reset(self):
+        with self.condition:
+            self.crash_id_ranges = {}
+            self.finished_groups = set()
+            self.condition.notify_all()
+
+    def publish_crash_id_range(self, group_index, crash_id_range):
+        with self.condition:
+            self.crash_id_ranges[group_index] = crash_id_range
+            self.condition.notify_all()
+
+    def finish(self, group_index):
+        with self.condition:
+            self.finished_groups.add(group_index)
+            self.condition.notify_all()
+
+    def is_clear_of(self, group_index, other_index):
+        if other_index in self.finished_groups:
+            return True
+        if other_index not in self.crash_id_ranges:
+            return False
+        return not ranges_overlap(
+            self.crash_id_ranges.get(group_index), self.crash_id_ranges[other_index]
+        )
+
+    def wait_for_overlapping_groups(self, group_index, timeout=None):
+        """
+        Block until no group ahead of the given one could still write a crash_id within its range, raising a
+        TimeoutError if that takes longer than `timeout` seconds.
+
+        Returns: A list of the indices of the groups which were waited on
+        """
+        with self.condition:
+            waited_on = [
+                other_index
+                for other_index in range(group_index)
+                if not self.is_clear_of(group_index, other_index)
+            ]
+            cleared = self.condition.wait_for(
+                lambda: all(
+                    self.is_clear_of(group_index, other_index)
+                    for other_index in range(group_index)
+                ),
+                timeout=timeout,
+            )
+            if not cleared:
+                raise TimeoutError(
+                    f"Logical group {group_index} timed out waiting on overlapping groups"
+                )
+            return waited_on
+
+
+def ranges_overlap(range_a, range_b):
+    # a group without any crash_ids can't overlap another one
+    if not range_a or not range_b:
+        return False
+    return range_a[0] <= range_b[1] and range_b[0] <= range_a[1]
+
+
+sequencer = LogicalGroupSequencer()
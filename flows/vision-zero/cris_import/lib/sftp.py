@@ -0,0 +1,67 @@
+import os
+import shlex
+import tempfile
+import subprocess
+
+# This file holds the SSH session the CRIS import uses to reach the SFTP endpoint CRIS delivers archives to.
+# OpenSSH's connection multiplexing lets the rsync which downloads the archives and the command which later
+# removes them share one connection: the first of them opens a master connection, which is kept alive in the
+# background, and the rest are run as new channels on it without another handshake. If the master has gone
+# away by the time it's needed again, it's simply opened anew.
+
+
+class SshSession:
+    def __init__(self, endpoint, persist="1h"):
+        self.endpoint = endpoint
+        # %C is a hash of the connection's details, which keeps the socket's path short and unique to the endpoint
+        self.control_path = os.path.join(tempfile.gettempdir(), "cris_import_ssh_%C")
+        self.persist = persist
+
+    def get_ssh_options(self):
+        return [
+            "-o", "ControlMaster=auto",
+            "-o", f"ControlPath={self.control_path}",
+            "-o", f"ControlPersist={self.persist}",
+        ]
+
+    def get_rsync_shell(self):
+        # the remote shell rsync should use to ride on the session, quoted as a single argument for `rsync -e`
+        return "-e " + shlex.quote(" ".join(["ssh"] + self.get_ssh_options()))
+
+    def run(self, remote_command):
+        command = ["ssh"] + self.get_ssh_options() + [self.endpoint, remote_command]
+        return subprocess.run(command, capture_output=True, text=True)
+
+    def remove_files(self, paths):
+        """
+        Remove files from the endpoint with a single remote command. A file which is already gone counts as
+        removed, as an earlier run may have removed it without its local copy being cleaned up.
+
+        Returns: A dictionary of each path and whether it was "removed" or "failed"
+        """
+        if not paths:
+            return {}
+        script = (
+            "for path in " + " ".join(shlex.quote(path) for path in paths) + "; do "
+            'if [ ! -e "$path" ] || rm -- "$path"; then echo "removed $path"; else echo "failed $path"; fi; '
+            "done"
+        )
+        result = self.run(script)
+        if result.returncode != 0:
+            raise Exception(
+                f"Unable to remove files from {self.endpoint}, ssh exited with {result.returncode}: {result.stderr.strip()}"
+            )
+
+        statuses = {path: "failed" for path in paths}
+        for line in result.stdout.splitlines():
+            status, _, path = line.partition(" ")
+            if path in statuses:
+                statuses[path] = status
+        return statuses
+
+    def close(self):
+        # ask the master connection, if there's one, to exit now instead of waiting out its persistence
+        subprocess.run(
+            ["ssh"] + self.get_ssh_options() + ["-O", "exit", self.endpoint],
+            capture_output=True,
+        )
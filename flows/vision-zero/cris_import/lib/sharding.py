@@ -0,0 +1,208 @@
+import time
+import queue
+import threading
+
+import psycopg2
+
+import lib.sql as util
+from lib.applier import StatementApplier
+import lib.instrumentation as instrumentation
+
+# This file applies the set-based INSERT and UPDATE statements which align the VZDB with a logical group's
+# classified records using several connections at once. Each statement is split into shards, each covering a
+# contiguous range of crash_ids, and the shards are applied by a handful of workers, each on a connection of
+# its own, in one transaction per shard. The tables are applied in phases: the tables of a phase are applied
+# side by side, but only once every table of the phase before has been applied, as the child tables reference
+# the crashes. The workers borrow their connections from the pool while the group's own connection is held, so
+# the flow insists on the pool having more connections than there are logical groups processed at once.
+#
+# While the workers run, the connection which classified the records checks every so often whether any of them
+# is waiting on a lock, and the time spent waiting is tallied against the shard the worker is applying.
+#
+# A shard which fails is rolled back by itself, and its records are then applied one at a time by a
+# `StatementApplier`, each under a savepoint of its own, so only the records which fail are rolled back and
+# written to the logical group's rejects file, and the rest of the shard is kept.
+
+LOCK_SAMPLE_SECONDS = 0.5
+
+
+class ApplyScheduler:
+    def __init__(self, connection, workers, batch_size, rejects, dry_run):
+        """
+        Arguments:
+            connection: A callable returning a context manager which lends out a psycopg2 connection
+            workers: How many shards may be applied at the same time, each on its own connection
+            batch_size: How many records of a failed shard to commit together as they're applied one at a time
+            rejects: The RejectsFile the records which fail are written to
+            dry_run: If set, nothing is applied
+        """
+        self.connection = connection
+        self.workers = max(1, workers)
+        # the records of a failed shard are always applied under savepoints, so the ones which fail are rejected
+        self.batch_size = max(1, batch_size)
+        self.rejects = rejects
+        self.dry_run = dry_run
+        self.shards = {}
+        self.active = {}
+        self.errors = []
+        self.lock = threading.Lock()
+        # the workers' statements are counted against the task which made the scheduler
+        self.measurement = instrumentation.current()
+
+    def submit(self, output_map, table, action, DB_IMPORT_SCHEMA, key_columns, crash_id_ranges, form_statement):
+        """
+        Queue a statement to be applied in shards.
+
+        Arguments:
+            output_map: The mapping of imported table names to VZDB table names
+            table: The name of the imported table, such as `crash`
+            action: What the statement does, such as "insert" or "update"
+            DB_IMPORT_SCHEMA: The logical group's import schema
+            key_columns: The names of the columns which key the table's records
+            crash_id_ranges: A list of crash_id ranges, as returned by `util.get_crash_id_shards`
+            form_statement: A callable which forms the statement restricted to a shard, given a clause picking it out
+        """
+        for index, crash_id_range in enumerate(crash_id_ranges):
+            shard_clause = util.form_crash_id_shard_clause(DB_IMPORT_SCHEMA, table, crash_id_range)
+            self.shards.setdefault(table, []).append({
+                "output_map": output_map,
+                "import_table": table,
+                "import_schema": DB_IMPORT_SCHEMA,
+                "key_columns": key_columns,
+                "form_statement": form_statement,
+                "table": output_map[table],
+                "action": action,
+                "shard": f"{index + 1}/{len(crash_id_ranges)}",
+                "crash_ids": [crash_id_range["min_crash_id"], crash_id_range["max_crash_id"]],
+                "where": shard_clause,
+                "statement": form_statement(shard_clause),
+                "status": "pending",
+                "rows": 0,
+                "rejected_keys": set(),
+                "seconds": 0.0,
+                "lock_wait_seconds": 0.0,
+            })
+
+    def work(self, pending):
+        try:
+            with instrumentation.attach(self.measurement), self.connection() as pg:
+                pid = pg.get_backend_pid()
+                while True:
+                    try:
+                        shard = pending.get_nowait()
+                    except queue.Empty:
+                        return
+                    self.apply(pg, pid, shard)
+        except Exception as error:
+            with self.lock:
+                self.errors.append(error)
+
+    def apply(self, pg, pid, shard):
+        with self.lock:
+            self.active[pid] = shard
+        started = time.monotonic()
+        cursor = pg.cursor()
+        try:
+            cursor.execute(shard["statement"])
+            shard["rows"] = cursor.rowcount
+            pg.commit()
+            shard["status"] = "applied"
+        except psycopg2.Error as error:
+            pg.rollback()
+            print(f"The {shard['action']} shard {shard['shard']} of {shard['table']} failed, applying its records one at a time: {str(error).strip()}")
+            self.apply_row_by_row(pg, shard)
+            shard["status"] = "rejected" if shard["rejected_keys"] else "applied"
+        finally:
+            with self.lock:
+                self.active.pop(pid, None)
+            shard["seconds"] = round(time.monotonic() - started, 3)
+        print(
+            f"{shard['status'].capitalize()} {shard['action']} shard {shard['shard']} of {shard['table']} "
+            f"(crash_ids {shard['crash_ids'][0]} to {shard['crash_ids'][1]}): {shard['rows']} rows in {shard['seconds']}s, "
+            f"{shard['lock_wait_seconds']}s waiting on locks"
+        )
+
+    def apply_row_by_row(self, pg, shard):
+        output_map, table, key_columns = shard["output_map"], shard["import_table"], shard["key_columns"]
+        key_clause = util.form_classified_key_clause(shard["import_schema"], table, key_columns)
+        statement = shard["form_statement"](f"{shard['where']} and {key_clause}")
+        keys = util.get_classified_keys(pg, shard["import_schema"], table, key_columns, shard["action"], shard["where"])
+
+        shard["rows"] = 0
+        with StatementApplier(pg, self.batch_size, self.rejects, False) as applier:
+            for key in keys:
+                record_key_sql = " and ".join([f"{column} = {value}" for column, value in zip(key_columns, key)])
+                if applier.apply(output_map, table, record_key_sql, statement, key):
+                    shard["rows"] += 1
+                else:
+                    shard["rejected_keys"].add(tuple(key))
+
+    def sample_lock_waits(self, pg):
+        with self.lock:
+            active = dict(self.active)
+        if not active:
+            return
+        for pid in util.get_lock_waiting_backends(pg, active.keys()):
+            active[pid]["lock_wait_seconds"] = round(active[pid]["lock_wait_seconds"] + LOCK_SAMPLE_SECONDS, 3)
+
+    def run_phase(self, pg, tables):
+        pending = queue.Queue()
+        for table in tables:
+            for shard in self.shards.get(table, []):
+                pending.put(shard)
+        if pending.empty():
+            return
+
+        workers = [threading.Thread(target=self.work, args=(pending,)) for _ in range(min(self.workers, pending.qsize()))]
+        for worker in workers:
+            worker.start()
+        while any(worker.is_alive() for worker in workers):
+            self.sample_lock_waits(pg)
+            time.sleep(LOCK_SAMPLE_SECONDS)
+        for worker in workers:
+            worker.join()
+
+        if self.errors:
+            raise self.errors[0]
+
+    def run(self, pg, phases):
+        """
+        Apply every queued shard, a phase at a time.
+
+        Arguments:
+            pg: A psycopg2 connection, which is used to watch for lock waits
+            phases: A list of lists of table names, as returned by `mappings.get_apply_phases`
+
+        Returns: A report of how each table's shards were applied, as returned by `get_report`
+        """
+        if self.dry_run:
+            print("Dry run; skipping")
+        else:
+            for tables in phases:
+                self.run_phase(pg, tables)
+        return self.get_report()
+
+    def is_applied(self, table, action, crash_id, key):
+        # whether a record was applied by the shard of a table's statement which covers its crash
+        for shard in self.shards.get(table, []):
+            if shard["action"] == action and shard["crash_ids"][0] <= crash_id <= shard["crash_ids"][1]:
+                return shard["status"] != "pending" and tuple(key) not in shard["rejected_keys"]
+        return False
+
+    def get_rejected_tables(self):
+        return {table for table, shards in self.shards.items() if any(shard["status"] == "rejected" for shard in shards)}
+
+    def get_report(self):
+        report = {"tables": {}, "rejects_path": self.rejects.get_path()}
+        for table, shards in self.shards.items():
+            report["tables"][table] = {
+                "rows": sum(shard["rows"] for shard in shards),
+                "seconds": round(sum(shard["seconds"] for shard in shards), 3),
+                "lock_wait_seconds": round(sum(shard["lock_wait_seconds"] for shard in shards), 3),
+                "rejected": sum(len(shard["rejected_keys"]) for shard in shards),
+                "shards": [
+                    {**{key: shard[key] for key in ["action", "shard", "crash_ids", "status", "rows", "seconds", "lock_wait_seconds"]}, "rejected": len(shard["rejected_keys"])}
+                    for shard in shards
+                ],
+            }
+        return report
@@ -1,9 +1,16 @@
 import os
+import psycopg2
 import psycopg2.extras
 
+from lib.records import ImportedRecord, get_column_positions
+import lib.instrumentation as instrumentation
+
 import pprint
 pp = pprint.PrettyPrinter(indent=4)
 
+# the column of each import table which numbers its rows in the order they were loaded
+IMPORT_ROW_COLUMN = "cris_import_row"
+
 # This library is /not/ designed for reuse in other projects. It is designed to increase the
 # readability of the `cris_import.py` prefect flow by pulling logical groups of code out
 # and replacing them with a descriptively named function. The code was reviewed with an
@@ -22,6 +29,16 @@ def get_pgfutter_path():
     return None
 
 
+def form_column_changed_expression(output_map, table, column, DB_IMPORT_SCHEMA):
+    # whether a column's value differs between a target record and an imported one. The changed column lists
+    # and the column diffs both use it, so a record is never found to have changed without a column to show for it.
+    return f"""not coalesce(
+                    public.{output_map[table]}.{column} = {DB_IMPORT_SCHEMA}.{table}.{column}
+                    or
+                    (public.{output_map[table]}.{column} is null and {DB_IMPORT_SCHEMA}.{table}.{column} is null)
+                , false)"""
+
+
 def get_column_operators(
     target_columns, no_override_columns, source, table, output_map, DB_IMPORT_SCHEMA
 ):
@@ -52,11 +69,7 @@ def get_column_operators(
             comparison_clause += ")"
 
             column_aggregator = f"""
-                case when not coalesce(
-                    public.{output_map[table]}.{column['column_name']} = {DB_IMPORT_SCHEMA}.{table}.{column['column_name']}
-                    or
-                    (public.{output_map[table]}.{column['column_name']} is null and {DB_IMPORT_SCHEMA}.{table}.{column['column_name']} is null)
-                , false) then '{column['column_name']}' else null end
+                case when {form_column_changed_expression(output_map, table, column['column_name'], DB_IMPORT_SCHEMA)} then '{column['column_name']}' else null end
             """
 
             if column["column_name"] in no_override_columns:
@@ -72,8 +85,7 @@ def get_column_operators(
     return column_assignments, column_comparisons, column_aggregators, important_column_assignments, important_column_comparisons, important_column_aggregators
 
 
-def check_if_update_is_a_non_op(
-    pg,
+def form_non_op_statement(
     column_comparisons,
     output_map,
     table,
@@ -81,7 +93,9 @@ def check_if_update_is_a_non_op(
     public_key_sql,
     DB_IMPORT_SCHEMA,
 ):
-    sql = "select (" + " and ".join(column_comparisons) + ") as skip_update\n"
+    # with no columns to compare, there's nothing an update could change
+    skip_update_sql = " and ".join(column_comparisons) if column_comparisons else "true"
+    sql = "select (" + skip_update_sql + ") as skip_update\n"
     sql += f"from public.{output_map[table]}\n"
     sql += (
         f"left join {DB_IMPORT_SCHEMA}.{table} on ("
@@ -89,43 +103,7 @@ def check_if_update_is_a_non_op(
         + ")\n"
     )
     sql += f"where {public_key_sql}\n"
-
-    cursor = pg.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-    cursor.execute(sql)
-    skip_update_query = cursor.fetchone()
-    if skip_update_query["skip_update"]:
-        return True
-    else:
-        return False
-
-
-def get_changed_columns(
-    pg,
-    column_aggregators,
-    output_map,
-    table,
-    linkage_clauses,
-    public_key_sql,
-    DB_IMPORT_SCHEMA,
-):
-    sql = "select "
-    sql += (
-        "array_remove(array["
-        + ",".join(column_aggregators)
-        + "], null)"
-        + "as changed_columns "
-    )
-    sql += f"from public.{output_map[table]} "
-    sql += (
-        f"left join {DB_IMPORT_SCHEMA}.{table} on ("
-        + " and ".join(linkage_clauses)
-        + ")\n"
-    )
-    sql += f"where {public_key_sql}\n"
-    cursor = pg.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-    cursor.execute(sql)
-    changed_columns = cursor.fetchone()
-    return changed_columns
+    return sql
 
 
 def get_key_clauses(table_keys, output_map, table, source, DB_IMPORT_SCHEMA):
@@ -140,18 +118,86 @@ def get_key_clauses(table_keys, output_map, table, source, DB_IMPORT_SCHEMA):
     return public_key_sql, import_key_sql
 
 
-def fetch_target_record(pg, output_map, table, public_key_sql):
-    # build and execute a query to find our target record; we're looking for it to exist
+def form_fetch_target_statement(output_map, table, public_key_sql):
+    # a query to find our target record; we're looking for it to exist
     sql = f"""
-    select * 
+    select 1 as target_exists
     from public.{output_map[table]}
     where 
     {public_key_sql}
     """
-    cursor = pg.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-    cursor.execute(sql)
-    target = cursor.fetchone()
-    return target
+    return sql
+
+
+def get_key_placeholder_clauses(key_columns, output_map, table, DB_IMPORT_SCHEMA):
+    # the same snippets as `get_key_clauses`, with a positional parameter standing in for each key value
+    public_key_clauses = []
+    import_key_clauses = []
+    for position, key in enumerate(key_columns, start=1):
+        public_key_clauses.append(f"public.{output_map[table]}.{key} = ${position}")
+        import_key_clauses.append(f"{DB_IMPORT_SCHEMA}.{table}.{key} = ${position}")
+    public_key_sql = " and ".join(public_key_clauses)
+    import_key_sql = " and ".join(import_key_clauses)
+    return public_key_sql, import_key_sql
+
+
+def form_row_alignment_templates(
+    output_map,
+    table,
+    key_columns,
+    input_column_names,
+    column_comparisons,
+    DB_IMPORT_SCHEMA,
+):
+    """
+    Form the statements used to align a table's records one at a time, once for the whole table. The
+    record's key values are bound to the `$1`, `$2`, ... parameters, in the order of the key columns.
+    The update statement is missing, as its assignments depend on the columns each record changes;
+    it's formed by `form_update_template`. The column diffs are found a batch of records at a time, with
+    the statement formed by `form_batch_column_diff_statement`.
+    """
+    public_key_sql, import_key_sql = get_key_placeholder_clauses(
+        key_columns, output_map, table, DB_IMPORT_SCHEMA
+    )
+    linkage_clauses, _ = get_linkage_constructions(
+        key_columns, output_map, table, DB_IMPORT_SCHEMA
+    )
+    return {
+        "fetch_target_record": form_fetch_target_statement(
+            output_map, table, public_key_sql
+        ),
+        "check_if_update_is_a_non_op": form_non_op_statement(
+            column_comparisons,
+            output_map,
+            table,
+            linkage_clauses,
+            public_key_sql,
+            DB_IMPORT_SCHEMA,
+        ),
+        "insert": form_insert_statement(
+            output_map, table, input_column_names, import_key_sql, DB_IMPORT_SCHEMA
+        ),
+    }
+
+
+def form_update_template(
+    output_map, table, key_columns, column_assignments, changed_columns, DB_IMPORT_SCHEMA
+):
+    public_key_sql, _ = get_key_placeholder_clauses(
+        key_columns, output_map, table, DB_IMPORT_SCHEMA
+    )
+    _, linkage_sql = get_linkage_constructions(
+        key_columns, output_map, table, DB_IMPORT_SCHEMA
+    )
+    return form_update_statement(
+        output_map,
+        table,
+        column_assignments,
+        DB_IMPORT_SCHEMA,
+        public_key_sql,
+        linkage_sql,
+        {"changed_columns": changed_columns},
+    )
 
 
 def form_update_statement(
@@ -191,55 +237,57 @@ def form_insert_statement(
     return sql
 
 
-def is_change_existing(pg, record_type, record_id):
-    #print(f"\b 🛎 is existing? {record_type}, {record_id}")
-
+@instrumentation.measured_helper
+def get_crash_ids_with_existing_changes(pg, DB_IMPORT_SCHEMA, tables):
+    # change requests are keyed by crash_id alone, whatever table the record they were made for is from
+    if not tables:
+        return set()
+    selects = [f"select crash_id from {DB_IMPORT_SCHEMA}.{table}" for table in tables]
     sql = f"""
-    select count(*) as exists
+    select distinct record_id
     from atd_txdot_changes_view
-    where record_id = {record_id}
+    where record_id in ({" union ".join(selects)})
     """
-
     cursor = pg.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
     cursor.execute(sql)
-    change_request_exists = cursor.fetchone()
-    if change_request_exists["exists"] > 0:
-        return True
-    else:
-        return False
+    return {row["record_id"] for row in cursor.fetchall()}
+
 
-def has_existing_temporary_record(pg, case_id):
+@instrumentation.measured_helper
+def get_case_ids_with_temporary_records(pg, DB_IMPORT_SCHEMA):
     sql = f"""
-    select count(*) as exists
+    select distinct case_id
     from atd_txdot_crashes
     where crash_id < 10000
-    and case_id = '{case_id}'
+    and case_id in (select case_id from {DB_IMPORT_SCHEMA}.crash)
     """
     cursor = pg.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
     cursor.execute(sql)
-    change_request_exists = cursor.fetchone()
-    if change_request_exists["exists"] > 0:
-        return True
-    else:
-        return False
+    return {row["case_id"] for row in cursor.fetchall()}
 
-def remove_existing_temporary_record(pg, case_id):
-    sql = f"""
+
+@instrumentation.measured_helper
+def remove_existing_temporary_records(pg, case_ids):
+    sql = """
     delete from atd_txdot_crashes
     where crash_id < 10000
-    and case_id = '{case_id}'
+    and case_id = any(%(case_ids)s)
     """
     cursor = pg.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-    cursor.execute(sql)
-    return True
+    cursor.execute(sql, {"case_ids": list(case_ids)})
+    pg.commit()
+    return cursor.rowcount
 
-def try_statement(pg, output_map, table, public_key_sql, sql, dry_run):
+
+@instrumentation.measured_helper
+def try_statement(pg, output_map, table, public_key_sql, sql, dry_run, parameters=None):
+    # returns whether the statement was run successfully
     if dry_run:
         print("Dry run; skipping")
-        return
+        return False
     try:
         cursor = pg.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-        cursor.execute(sql)
+        cursor.execute(sql, parameters)
         pg.commit()
     except Exception as error:
         print(
@@ -247,25 +295,12 @@ def try_statement(pg, output_map, table, public_key_sql, sql, dry_run):
         )
         print(f"Error executing:\n\n{sql}\n")
         print("\a")  # 🛎
+        return False
+    return True
 
 
-def get_input_column_names(pg, DB_IMPORT_SCHEMA, table, target_columns):
-    sql = f"""
-    SELECT
-        column_name,
-        data_type,
-        character_maximum_length AS max_length,
-        character_octet_length AS octet_length
-    FROM
-        information_schema.columns
-    WHERE true
-        AND table_schema = '{DB_IMPORT_SCHEMA}'
-        AND table_name = '{table}'
-    """
-
-    cursor = pg.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-    cursor.execute(sql)
-    input_table_column_types = cursor.fetchall()
+def get_input_column_names(catalog, DB_IMPORT_SCHEMA, table, target_columns):
+    input_table_column_types = catalog.get_columns(DB_IMPORT_SCHEMA, table)
 
     # TODO figure out how to .map() this
     input_column_names = []
@@ -283,33 +318,48 @@ def get_input_column_names(pg, DB_IMPORT_SCHEMA, table, target_columns):
     return valid_input_column_names
 
 
-def get_target_columns(pg, output_map, table):
-    sql = f"""
-    SELECT
-        column_name,
-        data_type,
-        character_maximum_length AS max_length,
-        character_octet_length AS octet_length
-    FROM
-        information_schema.columns
-    WHERE true
-        AND table_schema = 'public'
-        AND table_name = '{output_map[table]}'
-    """
-
-    cursor = pg.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-    cursor.execute(sql)
-    target_columns = cursor.fetchall()
+def get_target_columns(catalog, output_map, table):
+    target_columns = catalog.get_columns("public", output_map[table])
     return target_columns
 
 
-def load_input_data_for_keying(pg, DB_IMPORT_SCHEMA, table):
+def stream_records(pg, cursor_name, sql, itersize, leading_columns=0, parameters=None):
+    # A named cursor keeps the result set on the server and fetches it `itersize` rows at a time. It's
+    # declared WITH HOLD, as the records are applied, and committed, while they're still being read.
+    cursor = pg.cursor(name=cursor_name, withhold=True)
+    cursor.itersize = itersize
+    try:
+        cursor.execute(sql, parameters)
+        column_positions = None
+        for row in cursor:
+            if column_positions is None:
+                column_positions = get_column_positions(cursor.description[leading_columns:])
+            if leading_columns:
+                yield row[:leading_columns] + (ImportedRecord(column_positions, row[leading_columns:]),)
+            else:
+                yield ImportedRecord(column_positions, row)
+    finally:
+        cursor.close()
+
+
+def stream_input_data_for_keying(pg, DB_IMPORT_SCHEMA, table, itersize, key_columns, resume_after=None):
+    # the records are streamed in the order of their keys, so a rerun can resume after the last one applied
+    keys = ", ".join(key_columns)
     sql = f"select * from {DB_IMPORT_SCHEMA}.{table}"
+    if resume_after:
+        sql += f" where ({keys}) > ({', '.join(['%s'] * len(key_columns))})"
+    sql += f" order by {keys}, {IMPORT_ROW_COLUMN}"
+    return stream_records(pg, f"{DB_IMPORT_SCHEMA}_{table}_records", sql, itersize, parameters=resume_after)
 
-    cursor = pg.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-    cursor.execute(sql)
-    imported_records = cursor.fetchall()
-    return imported_records
+
+def get_postmaster_start_time(pg):
+    # unlogged tables are emptied if the server doesn't shut down cleanly, so checkpoints of an import
+    # schema's tables only hold for as long as the server has been up
+    cursor = pg.cursor()
+    cursor.execute("select pg_postmaster_start_time()::text")
+    started = cursor.fetchone()[0]
+    pg.commit()
+    return started
 
 
 def get_linkage_constructions(key_columns, output_map, table, DB_IMPORT_SCHEMA):
@@ -322,14 +372,14 @@ def get_linkage_constructions(key_columns, output_map, table, DB_IMPORT_SCHEMA):
     return linkage_clauses, linkage_sql
 
 
-def get_imported_tables(pg, DB_IMPORT_SCHEMA):
-    sql = f"SELECT * FROM information_schema.tables WHERE table_schema = '{DB_IMPORT_SCHEMA}';"
-    cursor = pg.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-    cursor.execute(sql)
-    imported_tables = cursor.fetchall()
+def get_imported_tables(catalog, DB_IMPORT_SCHEMA):
+    imported_tables = []
+    for table in catalog.get_tables(DB_IMPORT_SCHEMA):
+        imported_tables.append({"table_schema": DB_IMPORT_SCHEMA, "table_name": table})
     return imported_tables
 
 
+@instrumentation.measured_helper
 def enforce_complete_keying(
     pg, key_columns, output_table, DB_IMPORT_SCHEMA, input_table
 ):
@@ -347,114 +397,606 @@ def enforce_complete_keying(
     pg.commit()
 
 
-def get_output_column_types(pg, output_table):
-    # This is a subtle SQL injection attack vector.
-    # Beware the f-string. But I trust CRIS.
+def get_output_column_types(catalog, output_table):
+    output_column_types = catalog.get_columns("public", output_table)
+    return output_column_types
+
+
+def get_input_column_type(catalog, DB_IMPORT_SCHEMA, input_table, column):
+    input_column_type = catalog.get_column(DB_IMPORT_SCHEMA, input_table["table_name"], column["column_name"])
+    return [input_column_type] if input_column_type else []
+
+def get_input_tables_and_columns(catalog, DB_IMPORT_SCHEMA):
+    input_tables_and_columns = catalog.get_schema_columns(DB_IMPORT_SCHEMA)
+    return input_tables_and_columns
+
+@instrumentation.measured_helper
+def count_trailing_carriage_returns(pg, DB_IMPORT_SCHEMA, table, columns):
+    counters = []
+    for column in columns:
+        counters.append(f"count(*) filter (where {column['column_name']} ~ '[\\n\\r]$') as {column['column_name']}")
+    sql = f"""
+    select {", ".join(counters)}
+    from {DB_IMPORT_SCHEMA}.{table}
+    """
+    cursor = pg.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+    cursor.execute(sql)
+    counts = cursor.fetchone()
+    return {column: count for column, count in counts.items() if count}
+
+
+@instrumentation.measured_helper
+def trim_trailing_carriage_returns(pg, DB_IMPORT_SCHEMA, table, columns):
+    # one pass over the table which only rewrites the rows that have a value in need of trimming
+    assignments = []
+    conditions = []
+    for column in columns:
+        assignments.append(f"{column['column_name']} = regexp_replace({column['column_name']}, '[\\n\\r]*$', '', 'g')")
+        conditions.append(f"{column['column_name']} ~ '[\\n\\r]$'")
     sql = f"""
-    SELECT
-        column_name,
-        data_type,
-        character_maximum_length AS max_length,
-        character_octet_length AS octet_length
-    FROM
-        information_schema.columns
-    WHERE true
-        AND table_schema = 'public'
-        AND table_name = '{output_table}'
+    update {DB_IMPORT_SCHEMA}.{table}
+    set {", ".join(assignments)}
+    where {" or ".join(conditions)}
     """
-
     cursor = pg.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
     cursor.execute(sql)
-    output_column_types = cursor.fetchall()
-    return output_column_types
+    pg.commit()
+    return cursor.rowcount
+
+def form_typing_cast_expression(column):
+    # the `USING` hackery is due to the reality of the CSV null vs "" confusion
+    return f"case when {column['column_name']} = \'\' then null else {column['column_name']}::{column['data_type']} end"
 
 
-def get_input_column_type(pg, DB_IMPORT_SCHEMA, input_table, column):
+def form_alter_statement_to_apply_table_typing(DB_IMPORT_SCHEMA, input_table, columns):
+    # Postgres applies every ALTER COLUMN clause of a single ALTER TABLE in one rewrite of the table
+    alter_clauses = []
+    for column in columns:
+        alter_clauses.append(
+            f"""ALTER COLUMN {column["column_name"]} SET DATA TYPE {column["data_type"]}
+            USING {form_typing_cast_expression(column)}"""
+        )
+    return (
+        f"ALTER TABLE {DB_IMPORT_SCHEMA}.{input_table['table_name']}\n"
+        + ",\n".join(alter_clauses)
+    )
+
+
+@instrumentation.measured_helper
+def find_column_failing_typing(pg, DB_IMPORT_SCHEMA, input_table, columns):
+    # Evaluate each column's cast on its own with a read-only query to learn which one can't be typed.
+    # This is only done after the combined ALTER has failed, so the happy path still rewrites the table once.
+    cursor = pg.cursor()
+    for column in columns:
+        sql = f"""
+        select count({form_typing_cast_expression(column)})
+        from {DB_IMPORT_SCHEMA}.{input_table["table_name"]}
+        """
+        try:
+            cursor.execute(sql)
+            pg.rollback()
+        except psycopg2.Error as error:
+            pg.rollback()
+            return column, error
+    return None, None
+
+
+def form_column_diff_statement(
+    output_map,
+    table,
+    key_columns,
+    columns,
+    DB_IMPORT_SCHEMA,
+    where_sql,
+    join_sql="",
+    action_sql="'update'",
+):
+    # Each imported record is joined to the target record it's linked to, and every column is checked with the
+    # same comparison the changed column lists are made with, so an empty string and a null are reported as a
+    # difference here too. The values come back as jsonb, so they can be written out as they are.
+    linkage_clauses, _ = get_linkage_constructions(
+        key_columns, output_map, table, DB_IMPORT_SCHEMA
+    )
+    import_keys = [f"{DB_IMPORT_SCHEMA}.{table}.{key}" for key in key_columns]
+    column_values = ",\n            ".join(
+        [
+            f"""('{column}', to_jsonb(public.{output_map[table]}.{column}), to_jsonb({DB_IMPORT_SCHEMA}.{table}.{column}),
+                {form_column_changed_expression(output_map, table, column, DB_IMPORT_SCHEMA)})"""
+            for column in columns
+        ]
+    )
+
     sql = f"""
-    SELECT
-        column_name,
-        data_type,
-        character_maximum_length AS max_length,
-        character_octet_length AS octet_length
-    FROM
-        information_schema.columns
-    WHERE true
-        AND table_schema = '{DB_IMPORT_SCHEMA}'
-        AND table_name = '{input_table["table_name"]}'
-        AND column_name = '{column["column_name"]}'
+    select {action_sql} as action,
+        {", ".join(import_keys)},
+        diffs.column_name,
+        diffs.public_value,
+        diffs.import_value
+    from {DB_IMPORT_SCHEMA}.{table}
+    join public.{output_map[table]} on ({" and ".join(linkage_clauses)})
+    {join_sql}
+    cross join lateral (values
+            {column_values}
+    ) as diffs (column_name, public_value, import_value, changed)
+    where ({where_sql}) and diffs.changed
+    """
+    return sql
+
+
+def form_batch_column_diff_statement(output_map, table, key_columns, columns, DB_IMPORT_SCHEMA):
+    # the diffs of a whole batch of records at once; the keys of the batch are bound to the single parameter
+    # as a tuple of tuples, which psycopg2 writes out as a list of rows
+    import_keys = [f"{DB_IMPORT_SCHEMA}.{table}.{key}" for key in key_columns]
+    return form_column_diff_statement(
+        output_map,
+        table,
+        key_columns,
+        columns,
+        DB_IMPORT_SCHEMA,
+        "(" + ", ".join(import_keys) + ") in %s and " + form_latest_duplicate_clause(DB_IMPORT_SCHEMA, table, key_columns),
+    )
+
+
+def stream_classified_column_diffs(
+    pg, output_map, table, key_columns, columns, DB_IMPORT_SCHEMA, actions, itersize
+):
+    # yields an ImportedRecord of the record's action, its keys, the column name and both values
+    if not columns:
+        return iter(())
+    classification_linkage = get_classification_linkage(
+        key_columns, table, DB_IMPORT_SCHEMA
+    )
+    join_sql = f"join {DB_IMPORT_SCHEMA}.{table}_classification on ({classification_linkage})"
+    action_list = ", ".join([f"'{action}'" for action in actions])
+    sql = form_column_diff_statement(
+        output_map,
+        table,
+        key_columns,
+        columns,
+        DB_IMPORT_SCHEMA,
+        f"{DB_IMPORT_SCHEMA}.{table}_classification.action in ({action_list}) and "
+        + form_latest_duplicate_clause(DB_IMPORT_SCHEMA, table, key_columns),
+        join_sql,
+        f"{DB_IMPORT_SCHEMA}.{table}_classification.action",
+    )
+    return stream_records(
+        pg, f"{DB_IMPORT_SCHEMA}_{table}_column_diffs", sql, itersize
+    )
+
+
+def form_classification_statement(
+    output_map,
+    table,
+    key_columns,
+    column_comparisons,
+    column_aggregators,
+    important_column_aggregators,
+    DB_IMPORT_SCHEMA,
+):
+    # This builds one query which does, for every imported record at once, what the row-by-row strategy's
+    # target record lookup, non-op check and column diff do for a single record. The outcome is
+    # materialized into a classification table which sits beside the import table in the import schema.
+    linkage_clauses, _ = get_linkage_constructions(
+        key_columns, output_map, table, DB_IMPORT_SCHEMA
+    )
+
+    # a comparison which is null is neither equal nor unequal, and the row-by-row path treats that as "not a non-op"
+    skip_update_sql = (
+        "coalesce((" + " and ".join(column_comparisons) + "), false)"
+        if column_comparisons
+        else "true"
+    )
+
+    def changed_columns_array(aggregators):
+        if not aggregators:
+            return "array[]::text[]"
+        return "array_remove(array[" + ",".join(aggregators) + "]::text[], null)"
+
+    import_keys = [f"{DB_IMPORT_SCHEMA}.{table}.{key}" for key in key_columns]
+
+    sql = f"drop table if exists {DB_IMPORT_SCHEMA}.{table}_classification;\n"
+    sql += f"create table {DB_IMPORT_SCHEMA}.{table}_classification as\n"
+    sql += "select " + ", ".join(import_keys) + ",\n"
+    sql += f"""
+        case
+            when public.{output_map[table]}.{key_columns[0]} is null then 'insert'
+            when {skip_update_sql} then 'unchanged'
+            when cardinality({changed_columns_array(important_column_aggregators)}) > 0 then 'conflict'
+            else 'update'
+        end as action,
+        {changed_columns_array(column_aggregators)} as changed_columns,
+        {changed_columns_array(important_column_aggregators)} as important_changed_columns
     """
+    sql += f"from {DB_IMPORT_SCHEMA}.{table}\n"
+    sql += (
+        f"left join public.{output_map[table]} on ("
+        + " and ".join(linkage_clauses)
+        + ")\n"
+    )
+    sql += "where " + form_latest_duplicate_clause(DB_IMPORT_SCHEMA, table, key_columns) + "\n"
+    return sql
+
 
+@instrumentation.measured_helper
+def classify_imported_records(
+    pg,
+    output_map,
+    table,
+    key_columns,
+    column_comparisons,
+    column_aggregators,
+    important_column_aggregators,
+    DB_IMPORT_SCHEMA,
+):
+    sql = form_classification_statement(
+        output_map,
+        table,
+        key_columns,
+        column_comparisons,
+        column_aggregators,
+        important_column_aggregators,
+        DB_IMPORT_SCHEMA,
+    )
     cursor = pg.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
     cursor.execute(sql)
-    input_column_type = cursor.fetchall()
-    return input_column_type
 
-def get_input_tables_and_columns(pg, DB_IMPORT_SCHEMA):
     sql = f"""
-    SELECT
-        table_name,
-        column_name,
-        data_type,
-        character_maximum_length AS max_length,
-        character_octet_length AS octet_length
-    FROM
-        information_schema.columns
-    WHERE true
-        AND table_schema = '{DB_IMPORT_SCHEMA}'
+    select action, count(*) as records
+    from {DB_IMPORT_SCHEMA}.{table}_classification
+    group by action
+    """
+    cursor.execute(sql)
+    classification_counts = {"insert": 0, "unchanged": 0, "update": 0, "conflict": 0}
+    for row in cursor.fetchall():
+        classification_counts[row["action"]] = row["records"]
+    pg.commit()
+    return classification_counts
+
+
+def get_classification_linkage(key_columns, table, DB_IMPORT_SCHEMA):
+    return " and ".join(
+        [
+            f"{DB_IMPORT_SCHEMA}.{table}_classification.{key} = {DB_IMPORT_SCHEMA}.{table}.{key}"
+            for key in key_columns
+        ]
+    )
+
+
+def form_set_based_insert_statement(
+    output_map, table, key_columns, input_column_names, DB_IMPORT_SCHEMA, shard_clause=None
+):
+    classification_linkage = get_classification_linkage(
+        key_columns, table, DB_IMPORT_SCHEMA
+    )
+    import_keys = [f"{DB_IMPORT_SCHEMA}.{table}.{key}" for key in key_columns]
+    import_columns = [
+        f"{DB_IMPORT_SCHEMA}.{table}.{column}" for column in input_column_names
+    ]
+
+    sql = f"insert into public.{output_map[table]} "
+    sql += "(" + ", ".join(input_column_names) + ") "
+    sql += "(select distinct on (" + ", ".join(import_keys) + ") "
+    sql += ", ".join(import_columns)
+    sql += f" from {DB_IMPORT_SCHEMA}.{table}"
+    sql += f" join {DB_IMPORT_SCHEMA}.{table}_classification on ({classification_linkage})"
+    sql += f" where {DB_IMPORT_SCHEMA}.{table}_classification.action = 'insert'"
+    if shard_clause:
+        sql += f" and {shard_clause}"
+    # of the records which share keys, the one loaded last is inserted
+    sql += " order by " + ", ".join(import_keys) + f", {DB_IMPORT_SCHEMA}.{table}.{IMPORT_ROW_COLUMN} desc"
+    sql += ")"
+    return sql
+
+
+def form_set_based_update_statement(
+    output_map, table, key_columns, column_assignments, DB_IMPORT_SCHEMA, shard_clause=None
+):
+    # Each record is to have only the columns which differ assigned, like `form_update_statement` does. Every other
+    # column is assigned its own current value, so a single statement can serve records with differing changed columns.
+    classification_linkage = get_classification_linkage(
+        key_columns, table, DB_IMPORT_SCHEMA
+    )
+    linkage_clauses, _ = get_linkage_constructions(
+        key_columns, output_map, table, DB_IMPORT_SCHEMA
+    )
+
+    assignments = []
+    for column in column_assignments.keys():
+        assignments.append(
+            f"""{column} = case when '{column}' = any({DB_IMPORT_SCHEMA}.{table}_classification.changed_columns)
+                then {DB_IMPORT_SCHEMA}.{table}.{column}
+                else public.{output_map[table]}.{column} end"""
+        )
+
+    sql = "update public." + output_map[table] + " set "
+    sql += ",\n".join(assignments) + " "
+    sql += f"""
+    from {DB_IMPORT_SCHEMA}.{table}
+    join {DB_IMPORT_SCHEMA}.{table}_classification on ({classification_linkage})
+    where {DB_IMPORT_SCHEMA}.{table}_classification.action = 'update'
+    and {" and ".join(linkage_clauses)}
+    and {form_latest_duplicate_clause(DB_IMPORT_SCHEMA, table, key_columns)}
     """
+    if shard_clause:
+        sql += f"and {shard_clause}\n"
+    return sql
 
+
+@instrumentation.measured_helper
+def get_crash_id_shards(pg, DB_IMPORT_SCHEMA, table, actions, shard_count):
+    # splits the distinct crash_ids of the classified records into contiguous ranges of about the same
+    # number of crash_ids, so every record of a crash falls in the same shard
+    sql = f"""
+    select min(crash_id) as min_crash_id, max(crash_id) as max_crash_id, count(*) as crash_ids
+    from (
+        select crash_id, ntile(%(shard_count)s) over (order by crash_id) as shard
+        from (
+            select distinct crash_id
+            from {DB_IMPORT_SCHEMA}.{table}_classification
+            where action = any(%(actions)s)
+        ) crash_ids
+    ) sharded_crash_ids
+    group by shard
+    order by shard
+    """
     cursor = pg.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-    cursor.execute(sql)
-    input_tables_and_columns = cursor.fetchall()
-    return input_tables_and_columns
+    cursor.execute(sql, {"shard_count": shard_count, "actions": actions})
+    shards = [dict(row) for row in cursor.fetchall()]
+    pg.commit()
+    return shards
+
+
+def form_crash_id_shard_clause(DB_IMPORT_SCHEMA, table, shard):
+    return f"{DB_IMPORT_SCHEMA}.{table}_classification.crash_id between {shard['min_crash_id']} and {shard['max_crash_id']}"
+
+
+def form_classified_key_clause(DB_IMPORT_SCHEMA, table, key_columns):
+    # picks out a single classified record, with its key values bound to the statement's parameters
+    return " and ".join([f"{DB_IMPORT_SCHEMA}.{table}_classification.{key} = %s" for key in key_columns])
+
+
+@instrumentation.measured_helper
+def get_classified_keys(pg, DB_IMPORT_SCHEMA, table, key_columns, action, shard_clause):
+    keys = ", ".join(key_columns)
+    sql = f"""
+    select {keys}
+    from {DB_IMPORT_SCHEMA}.{table}_classification
+    where action = %(action)s and {shard_clause}
+    order by {keys}
+    """
+    cursor = pg.cursor()
+    cursor.execute(sql, {"action": action})
+    keys = [list(row) for row in cursor.fetchall()]
+    pg.commit()
+    return keys
+
+
+def get_lock_waiting_backends(pg, pids):
+    cursor = pg.cursor()
+    cursor.execute(
+        "select pid from pg_stat_activity where pid = any(%(pids)s) and wait_event_type = 'Lock'",
+        {"pids": list(pids)},
+    )
+    waiting = {row[0] for row in cursor.fetchall()}
+    pg.commit()
+    return waiting
+
+
+def stream_classified_records(pg, DB_IMPORT_SCHEMA, table, key_columns, action, itersize):
+    # yields a tuple of the changed columns, the important changed columns and the imported record
+    classification_linkage = get_classification_linkage(
+        key_columns, table, DB_IMPORT_SCHEMA
+    )
+    sql = f"""
+    select {DB_IMPORT_SCHEMA}.{table}_classification.changed_columns,
+        {DB_IMPORT_SCHEMA}.{table}_classification.important_changed_columns,
+        {DB_IMPORT_SCHEMA}.{table}.*
+    from {DB_IMPORT_SCHEMA}.{table}
+    join {DB_IMPORT_SCHEMA}.{table}_classification on ({classification_linkage})
+    where {DB_IMPORT_SCHEMA}.{table}_classification.action = '{action}'
+    """
+    return stream_records(
+        pg, f"{DB_IMPORT_SCHEMA}_{table}_{action}_records", sql, itersize, leading_columns=2
+    )
+
 
-def trim_trailing_carriage_returns(pg, DB_IMPORT_SCHEMA, column):
+def stream_classified_changes(pg, DB_IMPORT_SCHEMA, table, key_columns, itersize):
+    # yields an ImportedRecord of the keys, action and changed columns of each record which was not unchanged
+    sql = f"""
+    select {", ".join(key_columns)}, action, changed_columns, important_changed_columns
+    from {DB_IMPORT_SCHEMA}.{table}_classification
+    where action in ('insert', 'update', 'conflict')
+    """
+    return stream_records(
+        pg, f"{DB_IMPORT_SCHEMA}_{table}_changes", sql, itersize
+    )
+
+
+@instrumentation.measured_helper
+def drop_classification_table(pg, DB_IMPORT_SCHEMA, table):
+    cursor = pg.cursor()
+    cursor.execute(f"drop table if exists {DB_IMPORT_SCHEMA}.{table}_classification")
+    pg.commit()
+
+
+def form_import_table_statement(DB_IMPORT_SCHEMA, table, headers, unlogged=False):
+    # every column starts out as text; `align_db_typing` applies the VZDB types once the data is loaded.
+    # an import table is dropped with its schema at the end of the run, so it needn't be written to the WAL.
+    # the identity column numbers the rows in the order they were loaded, so duplicated keys can be told apart.
+    sql = f"drop table if exists {DB_IMPORT_SCHEMA}.{table};\n"
+    sql += f"create {'unlogged ' if unlogged else ''}table {DB_IMPORT_SCHEMA}.{table} (\n"
+    sql += ",\n".join([f"    {header} character varying" for header in headers] + [f"    {IMPORT_ROW_COLUMN} bigint generated always as identity"])
+    sql += "\n);"
+    return sql
+
+
+def form_latest_duplicate_clause(DB_IMPORT_SCHEMA, table, key_columns):
+    # a CSV can hold more than one record with the same keys; like applying them one after the other would,
+    # the one loaded last wins, so only it is classified and applied
+    linkage = " and ".join([f"later.{key} = {DB_IMPORT_SCHEMA}.{table}.{key}" for key in key_columns])
+    return f"""not exists (
+        select 1 from {DB_IMPORT_SCHEMA}.{table} later
+        where {linkage} and later.{IMPORT_ROW_COLUMN} > {DB_IMPORT_SCHEMA}.{table}.{IMPORT_ROW_COLUMN}
+    )"""
+
+
+def form_copy_statement(DB_IMPORT_SCHEMA, table, headers, freeze=False):
+    # FORCE_NOT_NULL loads empty fields as empty strings, quoted or not, which is how
+    # the CSV null vs "" confusion is presented to the typing step. FREEZE writes the rows
+    # already frozen, which postgres only allows when the table was created in the same
+    # transaction, as `copy_csv_into_table` does.
+    columns = ", ".join(headers)
+    return f"""
+    copy {DB_IMPORT_SCHEMA}.{table} ({columns})
+    from stdin
+    with (format csv, header true, force_not_null ({columns}){", freeze true" if freeze else ""})
+    """
+
+
+@instrumentation.measured_helper
+def index_import_table(pg, DB_IMPORT_SCHEMA, table, key_columns):
+    # the alignment queries join each import table to its VZDB table on the key columns, so they're indexed
+    # once the records are loaded and typed, and the table is analyzed, as autovacuum may not have got to it yet
+    cursor = pg.cursor()
+    cursor.execute(f"create index if not exists {table}_key_idx on {DB_IMPORT_SCHEMA}.{table} ({', '.join(key_columns)})")
+    cursor.execute(f"analyze {DB_IMPORT_SCHEMA}.{table}")
+    pg.commit()
+
+
+@instrumentation.measured_helper
+def get_crash_id_range(pg, DB_IMPORT_SCHEMA, tables):
+    # this runs before the import tables are typed, so anything which isn't a number is left to fail typing later on
+    if not tables:
+        return None
+    selects = [f"select crash_id from {DB_IMPORT_SCHEMA}.{table}" for table in tables]
+    sql = f"""
+    select min(crash_id::bigint) as min_crash_id, max(crash_id::bigint) as max_crash_id
+    from ({" union all ".join(selects)}) crash_ids
+    where crash_id ~ '^\\s*\\d+\\s*$'
+    """
     cursor = pg.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+    cursor.execute(sql)
+    crash_id_range = cursor.fetchone()
+    if crash_id_range["min_crash_id"] is None:
+        return None
+    return (crash_id_range["min_crash_id"], crash_id_range["max_crash_id"])
+
+
+def fingerprint_index_exists(pg):
+    cursor = pg.cursor()
+    cursor.execute("select to_regclass('cris_import_state.record_fingerprints') is not null")
+    exists = cursor.fetchone()[0]
+    pg.commit()
+    return exists
+
+
+def create_fingerprint_index(pg):
+    # The fingerprint index outlives the import schemas, so it has a schema of its own. It holds, for each record
+    # of each VZDB table which was last aligned with CRIS data, a hash of the CRIS data it was aligned with.
+    sql = """
+    create schema if not exists cris_import_state;
+    create table if not exists cris_import_state.record_fingerprints (
+        table_name character varying not null,
+        record_key character varying not null,
+        fingerprint character varying not null,
+        applied_at timestamp with time zone not null default now(),
+        primary key (table_name, record_key)
+    );
+    """
+    cursor = pg.cursor()
+    cursor.execute(sql)
+    pg.commit()
+
+
+def form_record_key_expression(DB_IMPORT_SCHEMA, table, key_columns):
+    key_values = [f"{DB_IMPORT_SCHEMA}.{table}.{key}::text" for key in key_columns]
+    return "concat_ws('|', " + ", ".join(key_values) + ")"
+
+
+def form_fingerprint_expression(DB_IMPORT_SCHEMA, table, columns):
+    # The columns are hashed in a fixed order, as their typed text, with a null and an empty string hashed
+    # alike, matching how a non-op update is decided. A unit separator keeps adjacent values from running together.
+    values = [
+        f"coalesce({DB_IMPORT_SCHEMA}.{table}.{column}::text, '')"
+        for column in sorted(columns)
+    ]
+    return "md5(concat_ws(chr(31), " + ", ".join(values) + "))"
+
+
+@instrumentation.measured_helper
+def fingerprint_records(pg, table, key_columns, input_column_names, DB_IMPORT_SCHEMA):
+    # the fingerprints are kept beside the import table until they're recorded as applied
+    record_key_sql = form_record_key_expression(DB_IMPORT_SCHEMA, table, key_columns)
+    fingerprint_sql = form_fingerprint_expression(
+        DB_IMPORT_SCHEMA, table, input_column_names
+    )
     sql = f"""
-    update {DB_IMPORT_SCHEMA}.{column["table_name"]}
-    set {column["column_name"]} = regexp_replace({column["column_name"]}, '[\\n\\r]*$', '', 'g')
+    drop table if exists {DB_IMPORT_SCHEMA}.{table}_fingerprint;
+    create table {DB_IMPORT_SCHEMA}.{table}_fingerprint as
+    select {", ".join([f"{DB_IMPORT_SCHEMA}.{table}.{key}" for key in key_columns])},
+        {record_key_sql} as record_key,
+        {fingerprint_sql} as fingerprint
+    from {DB_IMPORT_SCHEMA}.{table};
     """
+    cursor = pg.cursor()
     cursor.execute(sql)
     pg.commit()
 
-def form_alter_statement_to_apply_column_typing(DB_IMPORT_SCHEMA, input_table, column):
-    # the `USING` hackery is due to the reality of the CSV null vs "" confusion
-    return f"""
-            ALTER TABLE {DB_IMPORT_SCHEMA}.{input_table["table_name"]}
-            ALTER COLUMN {column["column_name"]} SET DATA TYPE {column["data_type"]}
-            USING case when {column["column_name"]} = \'\' then null else {column["column_name"]}::{column["data_type"]} end
-            """
 
+@instrumentation.measured_helper
+def drop_fingerprinted_records(
+    pg, output_map, table, key_columns, input_column_names, DB_IMPORT_SCHEMA
+):
+    """
+    Fingerprint each imported record and delete the imported records whose fingerprint
+    matches the one last applied to the VZDB record they're keyed to.
+
+    Returns: The number of imported records which were deleted
+    """
+    fingerprint_records(pg, table, key_columns, input_column_names, DB_IMPORT_SCHEMA)
 
-def show_changed_values(
-    pg,
-    changed_columns,
-    output_map,
-    table,
-    linkage_clauses,
-    record_key_sql,
-    DB_IMPORT_SCHEMA,
+    record_key_sql = form_record_key_expression(DB_IMPORT_SCHEMA, table, key_columns)
+    fingerprint_sql = form_fingerprint_expression(
+        DB_IMPORT_SCHEMA, table, input_column_names
+    )
+    sql = f"""
+    delete from {DB_IMPORT_SCHEMA}.{table}
+    using cris_import_state.record_fingerprints
+    where cris_import_state.record_fingerprints.table_name = '{output_map[table]}'
+    and cris_import_state.record_fingerprints.record_key = {record_key_sql}
+    and cris_import_state.record_fingerprints.fingerprint = {fingerprint_sql}
+    """
+    cursor = pg.cursor()
+    cursor.execute(sql)
+    deleted = cursor.rowcount
+    pg.commit()
+    return deleted
+
+
+@instrumentation.measured_helper
+def record_applied_fingerprints(
+    pg, output_map, table, DB_IMPORT_SCHEMA, excluded_crash_ids
 ):
-    for column in changed_columns["changed_columns"]:
-        print(column)
-        linkage_sql = " and ".join(linkage_clauses)
-        sql = f"""
-            select {DB_IMPORT_SCHEMA}.{table}.{column}::text as import_{column},
-                public.{output_map[table]}.{column}::text as public_{column}
-            from public.{output_map[table]}
-            left join {DB_IMPORT_SCHEMA}.{table} on {linkage_sql}
-            where {record_key_sql}
-            """
-        cursor = pg.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-        cursor.execute(sql)
-        values = cursor.fetchone()
-
-        if values[f"import_{column}"]:
-            # give some visible feedback for select special characters
-            values[f"import_{column}"] = values[f"import_{column}"].replace("\n", "\\n")
-            values[f"import_{column}"] = values[f"import_{column}"].replace("\r", "\\r")
-
-        print(f"Column update for {column} in {table}:")
-        print(f"  entity: {record_key_sql}")
-        print(f"  import: '{values[f'import_{column}']}'")
-        print(f"  public: '{values[f'public_{column}']}'")
+    # The fingerprints of this import become the last applied ones, save for those of records which were routed to the
+    # conflict resolution system instead of being applied, and of keys which were imported with differing data.
+    sql = f"""
+    insert into cris_import_state.record_fingerprints (table_name, record_key, fingerprint, applied_at)
+    select '{output_map[table]}', record_key, min(fingerprint), now()
+    from {DB_IMPORT_SCHEMA}.{table}_fingerprint
+    where not (crash_id = any(%(excluded_crash_ids)s))
+    group by record_key
+    having count(distinct fingerprint) = 1
+    on conflict (table_name, record_key) do update
+    set fingerprint = excluded.fingerprint, applied_at = excluded.applied_at
+    """
+    cursor = pg.cursor()
+    cursor.execute(sql, {"excluded_crash_ids": list(excluded_crash_ids)})
+    recorded = cursor.rowcount
+    pg.commit()
+    return recorded
+
+
+def drop_fingerprint_table(pg, DB_IMPORT_SCHEMA, table):
+    cursor = pg.cursor()
+    cursor.execute(f"drop table if exists {DB_IMPORT_SCHEMA}.{table}_fingerprint")
+    pg.commit()
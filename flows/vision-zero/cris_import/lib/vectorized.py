@@ -0,0 +1,229 @@
+import io
+import csv
+import tempfile
+
+import numpy
+import pandas
+
+import lib.sql as util
+
+# This file classifies a logical group's imported records in memory, as an alternative to the single joined
+# query `sql.classify_imported_records` makes. The imported records, and the VZDB records keyed to them, are
+# pulled in bulk with `COPY ... TO STDOUT` and compared a column at a time with vectorized operations. The
+# outcome is written back to the same classification table the SQL path makes, so the records are applied,
+# and their diffs recorded, the same way whichever engine classified them.
+#
+# Values are compared as the text postgres writes them out, which for two values of the same type is the same
+# text exactly when the values are equal, with the exception of the scale of numerics, which is trimmed on the
+# way out. The import tables are typed to the VZDB's types before this runs. The rules of `get_column_operators`
+# are followed exactly: a column is unchanged when its values are equal or both null, or, for text columns,
+# when one is null and the other is empty; but only the first two of those keep it out of the changed columns.
+
+COPY_NULL = "\\N"
+
+ENGINES = ["sql", "memory", "compare"]
+
+
+def get_select_expression(relation, column, numeric_scale_trimming):
+    if column["data_type"] == "numeric" and numeric_scale_trimming:
+        return f"trim_scale({relation}.{column['column_name']})"
+    return f"{relation}.{column['column_name']}"
+
+
+def copy_frame(pg, sql, columns):
+    """
+    Pull the results of a query with `COPY ... TO STDOUT` into a DataFrame of the values' text, with None for nulls.
+    Values are left escaped as COPY's text format escapes them, which keeps them distinct.
+    """
+    with tempfile.SpooledTemporaryFile(max_size=64 * 1024 * 1024, mode="w+b") as buffer:
+        pg.cursor().copy_expert(f"copy ({sql}) to stdout", buffer)
+        pg.commit()
+        if not buffer.tell():
+            return pandas.DataFrame({column: pandas.Series(dtype=object) for column in columns})
+        buffer.seek(0)
+        frame = pandas.read_csv(
+            buffer,
+            sep="\t",
+            header=None,
+            names=columns,
+            dtype=str,
+            na_values=[COPY_NULL],
+            keep_default_na=False,
+            quoting=csv.QUOTE_NONE,
+            encoding="utf-8",
+        )
+    return frame.replace({numpy.nan: None})
+
+
+def fetch_records(pg, output_map, table, key_columns, compared_columns, DB_IMPORT_SCHEMA):
+    """
+    Returns: A tuple of a DataFrame of the imported records and one of the VZDB records which share their keys,
+    each holding the key columns and then the rest of the compared columns
+    """
+    # trim_scale() came with postgres 13
+    numeric_scale_trimming = pg.server_version >= 130000
+    # the key columns are compared too, but they're only pulled once
+    compared_columns = [column for column in compared_columns if column["column_name"] not in key_columns]
+    columns = key_columns + [column["column_name"] for column in compared_columns]
+
+    import_relation = f"{DB_IMPORT_SCHEMA}.{table}"
+    public_relation = f"public.{output_map[table]}"
+    linkage = " and ".join([f"{public_relation}.{key} = {import_relation}.{key}" for key in key_columns])
+
+    import_sql = "select " + ", ".join(
+        [f"{import_relation}.{key}" for key in key_columns]
+        + [get_select_expression(import_relation, column, numeric_scale_trimming) for column in compared_columns]
+    ) + f" from {import_relation} where {util.form_latest_duplicate_clause(DB_IMPORT_SCHEMA, table, key_columns)}"
+
+    public_sql = "select " + ", ".join(
+        [f"{public_relation}.{key}" for key in key_columns]
+        + [get_select_expression(public_relation, column, numeric_scale_trimming) for column in compared_columns]
+    ) + f" from {public_relation} where exists (select 1 from {import_relation} where {linkage})"
+
+    return copy_frame(pg, import_sql, columns), copy_frame(pg, public_sql, columns)
+
+
+def compare_columns(public_values, import_values, data_type):
+    """
+    Returns: A tuple of two boolean arrays, whether each pair of values counts as equal for the non-op check,
+    and whether it counts as changed for the lists of changed columns
+    """
+    public_null = public_values.isna().to_numpy()
+    import_null = import_values.isna().to_numpy()
+    equal = ~public_null & ~import_null & (public_values.to_numpy() == import_values.to_numpy())
+    both_null = public_null & import_null
+
+    comparable = equal | both_null
+    if data_type in ("character varying", "text"):
+        comparable = comparable | (public_null & (import_values == "").to_numpy()) | ((public_values == "").to_numpy() & import_null)
+    return comparable, ~(equal | both_null)
+
+
+def classify_records(imported, existing, key_columns, compared_columns, no_override_columns):
+    """
+    Classify each imported record as an insert, unchanged, an update or a conflict, exactly as the SQL path's
+    classification statement does.
+
+    Arguments:
+        imported: A DataFrame of the imported records, as returned by `fetch_records`
+        existing: A DataFrame of the VZDB records which share their keys, as returned by `fetch_records`
+        key_columns: The names of the columns which key the records
+        compared_columns: The target table's columns, as described by the catalog, which are in the imported table
+        no_override_columns: The names of the columns protected from updates
+
+    Returns: A DataFrame of the imported records' keys, their action, and their changed and important changed columns
+    """
+    # a key which is null never joins in SQL, so a VZDB record without a complete key is never matched
+    existing = existing.dropna(subset=key_columns)
+    merged = imported.merge(existing, how="left", on=key_columns, suffixes=("_import", "_public"), indicator=True)
+    matched = (merged["_merge"] == "both").to_numpy()
+
+    unchanged = numpy.ones(len(merged), dtype=bool)
+    changed_names, changed = [], []
+    important_names, important_changed = [], []
+    for column in compared_columns:
+        name = column["column_name"]
+        if name in key_columns:
+            import_values, public_values = merged[name], merged[name].where(matched, None)
+        else:
+            import_values, public_values = merged[f"{name}_import"], merged[f"{name}_public"]
+        comparable, column_changed = compare_columns(public_values, import_values, column["data_type"])
+
+        if name in no_override_columns:
+            important_names.append(name)
+            important_changed.append(column_changed)
+        else:
+            # only the columns which aren't protected decide if the update would be a non-op
+            unchanged &= comparable
+            changed_names.append(name)
+            changed.append(column_changed)
+
+    def column_lists(names, masks):
+        if not names:
+            return [[] for _ in range(len(merged))], numpy.zeros(len(merged), dtype=bool)
+        matrix = numpy.column_stack(masks)
+        names = numpy.array(names, dtype=object)
+        return [list(names[row]) for row in matrix], matrix.any(axis=1)
+
+    changed_columns, _ = column_lists(changed_names, changed)
+    important_changed_columns, any_important_changed = column_lists(important_names, important_changed)
+
+    action = numpy.where(
+        ~matched, "insert", numpy.where(unchanged, "unchanged", numpy.where(any_important_changed, "conflict", "update"))
+    )
+
+    classification = merged[key_columns].copy()
+    classification["action"] = action
+    classification["changed_columns"] = changed_columns
+    classification["important_changed_columns"] = important_changed_columns
+    return classification
+
+
+def format_copy_array(values):
+    return "{" + ",".join(values) + "}"
+
+
+def write_classification_table(pg, classification, table, key_columns, DB_IMPORT_SCHEMA):
+    # the keys are created with the import table's types, and the rest as the SQL path creates them
+    cursor = pg.cursor()
+    cursor.execute(f"drop table if exists {DB_IMPORT_SCHEMA}.{table}_classification")
+    cursor.execute(
+        f"""
+        create table {DB_IMPORT_SCHEMA}.{table}_classification as
+        select {", ".join(key_columns)}, null::text as action, null::text[] as changed_columns, null::text[] as important_changed_columns
+        from {DB_IMPORT_SCHEMA}.{table}
+        where false
+        """
+    )
+
+    # the keys are still escaped as COPY wrote them, so they're handed back as they are
+    buffer = io.StringIO()
+    for record in classification.itertuples(index=False):
+        values = [COPY_NULL if value is None else value for value in record[: len(key_columns)]]
+        values += [record.action, format_copy_array(record.changed_columns), format_copy_array(record.important_changed_columns)]
+        buffer.write("\t".join(values) + "\n")
+    buffer.seek(0)
+    cursor.copy_expert(
+        f"copy {DB_IMPORT_SCHEMA}.{table}_classification ({', '.join(key_columns)}, action, changed_columns, important_changed_columns) from stdin",
+        buffer,
+    )
+    pg.commit()
+
+
+def count_actions(classification):
+    counts = {"insert": 0, "unchanged": 0, "update": 0, "conflict": 0}
+    counts.update(classification["action"].value_counts().to_dict())
+    return counts
+
+
+def classify_imported_records(pg, output_map, table, key_columns, target_columns, no_override_columns, input_column_names, DB_IMPORT_SCHEMA):
+    """
+    Classify a table's imported records in memory and write them to its classification table.
+
+    Returns: A tuple of the count of records in each class, and the classification's DataFrame
+    """
+    compared_columns = [column for column in target_columns if column["column_name"] in input_column_names]
+    imported, existing = fetch_records(pg, output_map, table, key_columns, compared_columns, DB_IMPORT_SCHEMA)
+    classification = classify_records(imported, existing, key_columns, compared_columns, no_override_columns)
+    write_classification_table(pg, classification, table, key_columns, DB_IMPORT_SCHEMA)
+    return count_actions(classification), classification
+
+
+def read_classification_table(pg, table, key_columns, DB_IMPORT_SCHEMA):
+    columns = key_columns + ["action", "changed_columns", "important_changed_columns"]
+    return copy_frame(pg, f"select {', '.join(columns)} from {DB_IMPORT_SCHEMA}.{table}_classification", columns)
+
+
+def compare_classifications(sql_classification, memory_classification, key_columns):
+    """
+    Returns: The number of records which the two engines classified differently, in action or in changed columns
+    """
+    memory_classification = memory_classification.copy()
+    for column in ["changed_columns", "important_changed_columns"]:
+        memory_classification[column] = memory_classification[column].map(format_copy_array)
+
+    columns = key_columns + ["action", "changed_columns", "important_changed_columns"]
+    sql_rows = sql_classification[columns].fillna(COPY_NULL).value_counts()
+    memory_rows = memory_classification[columns].fillna(COPY_NULL).value_counts()
+    differences = sql_rows.subtract(memory_rows, fill_value=0)
+    return int(differences.abs().sum())
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the flow imports its library as `lib`, relative to the flow's own directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
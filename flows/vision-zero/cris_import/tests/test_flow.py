@@ -0,0 +1,81 @@
+import sys
+import json
+import importlib
+
+import pytest
+
+prefect = pytest.importorskip("prefect")
+for module in ["boto3", "sysrsync", "zstandard", "sshtunnel", "pandas", "psycopg2"]:
+    pytest.importorskip(module)
+
+# the change request template comes from the VZ ETL's checkout, where the flow's image puts it
+sys.path.insert(0, "/root/cris_import/atd-vz-data/atd-etl/app")
+pytest.importorskip("process.helpers_import")
+
+# The flow is defined, and registered, as its module is imported. Prefect checks each task's signature as it's
+# decorated and each edge as the flow is built, so importing the module, with the key value store and registration
+# stood in for, catches a task or a wiring which prefect would refuse before the flow ever reaches the agent.
+
+KEY_VALUES = {
+    key: "test"
+    for key in [
+        "SFTP_ENDPOINT",
+        "ZIP_PASSWORD",
+        "VZ_ETL_LOCATION",
+        "AWS_DEFAULT_REGION",
+        "AWS_ACCESS_KEY_ID",
+        "AWS_SECRET_ACCESS_KEY",
+        "AWS_CSV_ARCHIVE_BUCKET_NAME",
+        "AWS_CSV_ARCHIVE_PATH_PRODUCTION",
+        "AWS_CSV_ARCHIVE_PATH_STAGING",
+        "DB_HOST",
+        "DB_USER",
+        "DB_PASS",
+        "DB_NAME",
+        "DB_SSL_REQUIREMENT",
+        "DB_BASTION_HOST_SSH_USERNAME",
+        "DB_BASTION_HOST",
+        "DB_RDS_HOST",
+    ]
+}
+
+
+@pytest.fixture
+def flow(monkeypatch, tmp_path):
+    import prefect.backend
+
+    key_values = {**KEY_VALUES, "CRIS_IMPORT_STATE_DIRECTORY": str(tmp_path)}
+    monkeypatch.setattr(prefect.backend, "get_key_value", lambda key: json.dumps(key_values))
+    registered = []
+    monkeypatch.setattr(prefect.Flow, "register", lambda self, **kwargs: registered.append(kwargs))
+    monkeypatch.delitem(sys.modules, "cris_import", raising=False)
+
+    module = importlib.import_module("cris_import")
+    assert registered == [{"project_name": "vision-zero"}]
+    yield module.flow
+    sys.modules.pop("cris_import", None)
+
+
+def get_task(flow, name):
+    tasks = [task for task in flow.tasks if task.name == name]
+    assert len(tasks) == 1, name
+    return tasks[0]
+
+
+def test_flow_is_built(flow):
+    flow.validate()
+    assert flow.name == "CRIS Crash Import"
+
+
+def test_connections_are_closed_once_the_groups_are_processed(flow):
+    close = get_task(flow, "Close database connections")
+    upstream = {edge.upstream_task.name: edge.key for edge in flow.edges_to(close)}
+    assert upstream == {"Merge": "processed_groups"}
+
+
+def test_performance_summary_waits_on_every_other_task(flow):
+    summary = get_task(flow, "Write performance summaries")
+    upstream = {edge.upstream_task.name for edge in flow.edges_to(summary)}
+    assert {"Close database connections"} <= upstream
+    assert all(edge.key is None for edge in flow.edges_to(summary))
+    assert len(upstream) == 3
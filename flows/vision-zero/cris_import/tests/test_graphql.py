@@ -0,0 +1,112 @@
+import json
+
+import pytest
+
+requests = pytest.importorskip("requests")
+
+import lib.graphql as graphql
+
+# Change requests are made by the VZ ETL's `insert_crash_change_template()`, one insert mutation a record; these
+# tests hold a batch of them to being sent as one bulk insert, and to what's done when a batch can't be sent.
+
+
+def make_mutation(crash_id, record):
+    # the shape of the documents the template makes, with the record as escaped JSON
+    record_json = json.dumps(record).replace('"', '\\"')
+    return f"""
+    mutation insertCrashChangeMutation {{
+      insert_atd_txdot_changes(
+        objects: {{
+          record_id: {crash_id},
+          record_json: "{record_json}",
+          record_uqid: {crash_id}
+          record_type: "crash",
+          affected_columns: "latitude, longitude",
+          status_id: 0,
+          updated_by: "System"
+        }},
+        on_conflict: {{
+          constraint: atd_txdot_changes_unique,
+          update_columns: [record_id, record_json, affected_columns, status_id, updated_by]
+        }}
+      ) {{
+        affected_rows
+      }}
+    }}
+    """
+
+
+def test_inserts_are_combined_into_one_bulk_insert():
+    mutations = [make_mutation(1, {"rpt_street_name": "MAIN {ST}"}), make_mutation(2, {"rpt_street_name": 'ELM "ST"'})]
+    combined = graphql.combine_mutations(mutations)
+
+    field, arguments = graphql.parse_insert_mutation(combined)
+    assert field == "insert_atd_txdot_changes"
+    assert [name for name, _ in arguments] == ["objects", "on_conflict"]
+    objects = arguments[0][1]
+    assert objects.startswith("[{") and objects.endswith("}]")
+    assert objects.count("record_id:") == 2
+    assert '\\"rpt_street_name\\": \\"MAIN {ST}\\"' in objects
+    assert "change_0" not in combined
+    assert combined.count("on_conflict") == 1
+
+
+def test_single_row_inserts_are_combined_into_a_bulk_insert():
+    mutations = [
+        'mutation { insert_atd_txdot_changes_one(object: {record_id: 1, record_type: "crash"}) { id } }',
+        'mutation { insert_atd_txdot_changes_one(object: {record_id: 2, record_type: "crash"}) { id } }',
+    ]
+    combined = graphql.combine_mutations(mutations)
+    assert 'insert_atd_txdot_changes(objects: [{record_id: 1, record_type: "crash"}, {record_id: 2, record_type: "crash"}])' in combined
+    assert "affected_rows" in combined
+
+
+def test_mutations_which_differ_are_aliased():
+    mutations = [
+        'mutation { insert_atd_txdot_changes(objects: {record_id: 1}) { affected_rows } }',
+        'mutation { insert_atd_txdot_crashes(objects: {crash_id: 2}) { affected_rows } }',
+    ]
+    combined = graphql.combine_mutations(mutations)
+    assert "change_0: insert_atd_txdot_changes(objects: {record_id: 1})" in combined
+    assert "change_1: insert_atd_txdot_crashes(objects: {crash_id: 2})" in combined
+
+
+def submit(monkeypatch, responses, mutations):
+    # each request takes the next response: the data Hasura returned, or the error it was answered with
+    sent = []
+
+    def make_hasura_request(*, query):
+        sent.append(query)
+        response = responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    monkeypatch.setattr(graphql, "make_hasura_request", make_hasura_request)
+    batcher = graphql.ChangeRequestBatcher(batch_size=len(mutations))
+    for crash_id, mutation in mutations:
+        batcher.add(mutation, crash_id)
+    return batcher, sent
+
+
+def test_batch_is_sent_once(monkeypatch):
+    mutations = [(1, make_mutation(1, {})), (2, make_mutation(2, {}))]
+    batcher, sent = submit(monkeypatch, [{}], mutations)
+    assert len(sent) == 1
+    assert batcher.get_report()["failed"] == 0
+
+
+def test_batch_which_times_out_is_sent_one_at_a_time(monkeypatch):
+    mutations = [(1, make_mutation(1, {})), (2, make_mutation(2, {}))]
+    batcher, sent = submit(monkeypatch, [requests.ReadTimeout("timed out"), {}, {}], mutations)
+    assert sent[1:] == [mutation for _, mutation in mutations]
+    batcher.raise_for_failures()
+
+
+def test_rejected_batch_is_sent_one_at_a_time_and_failures_raise(monkeypatch):
+    mutations = [(1, make_mutation(1, {})), (2, make_mutation(2, {}))]
+    batcher, sent = submit(monkeypatch, [ValueError({"errors": []}), {}, ValueError({"errors": ["bad record"]})], mutations)
+    assert len(sent) == 3
+    assert [failure["record_id"] for failure in batcher.failures] == [2]
+    with pytest.raises(Exception, match="1 change requests could not be submitted"):
+        batcher.raise_for_failures()
@@ -0,0 +1,173 @@
+import os
+import json
+from contextlib import contextmanager
+
+import pytest
+
+psycopg2 = pytest.importorskip("psycopg2")
+
+import lib.instrumentation as instrumentation
+
+# The registry keeps each task's measurements for the flow run, or for the logical group the task was given, and adds
+# up the attempts of a task which is retried; these tests hold it to that, and to the summaries it writes out.
+
+
+def make_measurement(name, seconds=1.0, rows=10, rss_change_mb=2.0, helpers=None):
+    measurement = instrumentation.Measurement(name)
+    measurement.calls = 1
+    measurement.seconds = seconds
+    measurement.count(round_trips=1, rows=rows)
+    measurement.rss_change_mb = rss_change_mb
+    measurement.helpers = helpers or {}
+    return measurement
+
+
+@pytest.fixture
+def registry():
+    return instrumentation.Registry()
+
+
+def test_task_without_a_group_is_recorded_for_the_run(registry):
+    registry.record(make_measurement("extract_archives"))
+    assert registry.tasks["extract_archives"]["rows"] == 10
+    assert registry.groups == {}
+
+
+def test_task_of_a_group_is_recorded_for_the_group(registry):
+    registry.record(make_measurement("align_records"), "2024_1")
+    assert registry.tasks == {}
+    assert registry.groups["2024_1"]["align_records"]["seconds"] == 1.0
+
+
+def test_retried_task_adds_up_its_attempts(registry):
+    helper = {"calls": 1, "seconds": 0.5, "round_trips": 1, "rows": 4, "bytes": 0}
+    registry.record(make_measurement("align_records", helpers={"upsert": dict(helper)}), "2024_1")
+    registry.record(make_measurement("align_records", seconds=2.0, rows=5, rss_change_mb=-1.0, helpers={"upsert": dict(helper)}), "2024_1")
+    recorded = registry.groups["2024_1"]["align_records"]
+    assert recorded["calls"] == 2
+    assert recorded["seconds"] == 3.0
+    assert recorded["round_trips"] == 2
+    assert recorded["rows"] == 15
+    assert recorded["rss_change_mb"] == 1.0
+    assert recorded["helpers"]["upsert"] == {"calls": 2, "seconds": 1.0, "round_trips": 2, "rows": 8, "bytes": 0}
+
+
+def test_same_task_of_different_groups_is_kept_apart(registry):
+    registry.record(make_measurement("align_records"), "2024_1")
+    registry.record(make_measurement("align_records"), "2024_2")
+    assert registry.groups["2024_1"]["align_records"]["calls"] == 1
+    assert registry.groups["2024_2"]["align_records"]["calls"] == 1
+
+
+def test_measured_task_finds_the_group_in_any_argument(monkeypatch, registry):
+    monkeypatch.setattr(instrumentation, "registry", registry)
+
+    @instrumentation.measured_task
+    def create_import_schema_name(mapped_state):
+        return mapped_state
+
+    @instrumentation.measured_task
+    def align_records(map_state):
+        return map_state
+
+    @instrumentation.measured_task
+    def group_csvs_into_logical_groups(extracted_archives, dry_run):
+        return extracted_archives
+
+    create_import_schema_name({"logical_group_id": "2024_1"})
+    align_records(map_state={"logical_group_id": "2024_1"})
+    group_csvs_into_logical_groups([{"archive_key": "archive"}], True)
+
+    assert sorted(registry.groups["2024_1"]) == ["align_records", "create_import_schema_name"]
+    assert list(registry.tasks) == ["group_csvs_into_logical_groups"]
+
+
+def test_failed_task_is_recorded(monkeypatch, registry):
+    monkeypatch.setattr(instrumentation, "registry", registry)
+
+    @instrumentation.measured_task
+    def load_csvs_into_database(map_state):
+        raise ValueError("failed")
+
+    with pytest.raises(ValueError):
+        load_csvs_into_database({"logical_group_id": "2024_1"})
+    assert registry.groups["2024_1"]["load_csvs_into_database"]["calls"] == 1
+
+
+def test_write_summaries(tmp_path, registry):
+    registry.record(make_measurement("extract_archives"))
+    registry.record(make_measurement("align_records"), "2024_1")
+    registry.record(make_measurement("load_csvs_into_database", seconds=0.5), "2024_1")
+    registry.record(make_measurement("align_records"), "2024_2")
+
+    paths = registry.write_summaries(str(tmp_path / "performance"))
+
+    assert [os.path.basename(path).split("_")[:2] for path in paths[:-1]] == [["2024", "1"], ["2024", "2"]]
+    assert os.path.basename(paths[-1]).startswith("run_")
+
+    with open(paths[0]) as file:
+        group = json.load(file)
+    assert group["logical_group_id"] == "2024_1"
+    assert group["seconds"] == 1.5
+    assert sorted(group["tasks"]) == ["align_records", "load_csvs_into_database"]
+
+    with open(paths[-1]) as file:
+        run = json.load(file)
+    assert list(run["tasks"]) == ["extract_archives"]
+    assert sorted(run["logical_groups"]) == ["2024_1", "2024_2"]
+    assert run["logical_groups"]["2024_1"] == group
+    assert run["peak_rss_mb"] > 0
+    assert "peak_rss_mb" not in run["tasks"]["extract_archives"]
+
+
+def test_task_whose_measurement_fails_raises_its_own_error(monkeypatch, registry):
+    monkeypatch.setattr(instrumentation, "registry", registry)
+
+    @contextmanager
+    def failing_measure(name):
+        raise OSError("can't measure")
+        yield
+
+    monkeypatch.setattr(instrumentation, "measure", failing_measure)
+
+    @instrumentation.measured_task
+    def align_records(map_state):
+        return map_state
+
+    with pytest.raises(OSError, match="can't measure"):
+        align_records({"logical_group_id": "2024_1"})
+    assert registry.groups == {}
+
+
+DATABASE_URL = os.getenv("CRIS_IMPORT_TEST_DATABASE_URL")
+
+
+@pytest.fixture
+def connection():
+    if not DATABASE_URL:
+        pytest.skip("CRIS_IMPORT_TEST_DATABASE_URL isn't set")
+    pg = psycopg2.connect(DATABASE_URL, connection_factory=instrumentation.InstrumentedConnection)
+    try:
+        yield pg
+    finally:
+        pg.close()
+
+
+def test_named_cursor_fetches_are_counted(connection):
+    import lib.sql as util
+
+    with instrumentation.measure("align_records") as measurement:
+        records = list(util.stream_records(connection, "counted_records", "select generate_series(1, 5) as crash_id", 2))
+    assert [record["crash_id"] for record in records] == [1, 2, 3, 4, 5]
+    # the declare, then fetches of 2, 2, 1 and none
+    assert measurement.counters["round_trips"] == 5
+    assert measurement.counters["rows"] == 5
+
+
+def test_client_side_cursor_rows_are_counted_once(connection):
+    with instrumentation.measure("align_records") as measurement:
+        cursor = connection.cursor()
+        cursor.execute("select generate_series(1, 5)")
+        assert len(cursor.fetchall()) == 5
+        assert len(list(cursor)) == 0
+    assert measurement.counters == {"round_trips": 1, "rows": 5, "bytes": 0}
@@ -0,0 +1,208 @@
+import os
+
+import pytest
+
+pandas = pytest.importorskip("pandas")
+psycopg2 = pytest.importorskip("psycopg2")
+
+import lib.sql as util
+import lib.vectorized as vectorized
+
+# The in-memory engine must classify records exactly as `sql.form_classification_statement` does. The first tests
+# hold it to the outcomes that statement's rules give for each case; the last one runs both engines against a
+# postgres database, if one is given in CRIS_IMPORT_TEST_DATABASE_URL, and compares what they wrote.
+
+KEY_COLUMNS = ["crash_id"]
+
+COMPARED_COLUMNS = [
+    {"column_name": "crash_id", "data_type": "integer"},
+    {"column_name": "rpt_street_name", "data_type": "character varying"},
+    {"column_name": "crash_speed_limit", "data_type": "integer"},
+    {"column_name": "latitude", "data_type": "numeric"},
+]
+
+NO_OVERRIDE_COLUMNS = ["latitude"]
+
+COLUMN_NAMES = [column["column_name"] for column in COMPARED_COLUMNS]
+
+
+def make_frame(rows):
+    # values are held as the text COPY writes them out, with None for nulls
+    return pandas.DataFrame(rows, columns=COLUMN_NAMES, dtype=object)
+
+
+def classify(imported, existing):
+    classification = vectorized.classify_records(
+        make_frame(imported), make_frame(existing), KEY_COLUMNS, COMPARED_COLUMNS, NO_OVERRIDE_COLUMNS
+    )
+    return [
+        (record.crash_id, record.action, list(record.changed_columns), list(record.important_changed_columns))
+        for record in classification.itertuples(index=False)
+    ]
+
+
+def test_record_without_a_target_is_inserted():
+    # the target's columns are all null, so each imported value which isn't null is a changed column
+    assert classify([["1", "MAIN ST", None, "30.1"]], []) == [
+        ("1", "insert", ["crash_id", "rpt_street_name"], ["latitude"]),
+    ]
+
+
+def test_identical_record_is_unchanged():
+    record = ["1", "MAIN ST", "30", "30.1"]
+    assert classify([record], [record]) == [("1", "unchanged", [], [])]
+
+
+def test_text_null_and_empty_string_are_not_an_update():
+    # either way round, a null and an empty string keep a text column from making an update, but unlike
+    # two nulls, the column is still listed as changed
+    assert classify([["1", "", "30", "30.1"]], [["1", None, "30", "30.1"]]) == [
+        ("1", "unchanged", ["rpt_street_name"], []),
+    ]
+    assert classify([["1", None, "30", "30.1"]], [["1", "", "30", "30.1"]]) == [
+        ("1", "unchanged", ["rpt_street_name"], []),
+    ]
+
+
+def test_text_nulls_are_equal():
+    assert classify([["1", None, "30", "30.1"]], [["1", None, "30", "30.1"]]) == [("1", "unchanged", [], [])]
+
+
+def test_non_text_null_is_an_update():
+    assert classify([["1", "MAIN ST", None, "30.1"]], [["1", "MAIN ST", "30", "30.1"]]) == [
+        ("1", "update", ["crash_speed_limit"], []),
+    ]
+    assert classify([["1", "MAIN ST", "35", "30.1"]], [["1", "MAIN ST", None, "30.1"]]) == [
+        ("1", "update", ["crash_speed_limit"], []),
+    ]
+
+
+def test_protected_column_alone_does_not_make_an_update():
+    # only the columns which aren't protected decide whether the update would be a non-op
+    assert classify([["1", "MAIN ST", "30", "30.2"]], [["1", "MAIN ST", "30", "30.1"]]) == [
+        ("1", "unchanged", [], ["latitude"]),
+    ]
+
+
+def test_protected_column_turns_an_update_into_a_conflict():
+    assert classify([["1", "MAIN ST", "35", "30.2"]], [["1", "MAIN ST", "30", "30.1"]]) == [
+        ("1", "conflict", ["crash_speed_limit"], ["latitude"]),
+    ]
+
+
+def test_update_without_protected_changes():
+    assert classify([["1", "ELM ST", "30", "30.1"]], [["1", "MAIN ST", "30", "30.1"]]) == [
+        ("1", "update", ["rpt_street_name"], []),
+    ]
+
+
+def test_duplicate_keys_are_each_classified_against_the_target():
+    # like the SQL's join, each imported record is compared with the target on its own
+    assert classify(
+        [["1", "MAIN ST", "30", "30.1"], ["1", "ELM ST", "30", "30.1"]],
+        [["1", "MAIN ST", "30", "30.1"]],
+    ) == [
+        ("1", "unchanged", [], []),
+        ("1", "update", ["rpt_street_name"], []),
+    ]
+
+
+def test_target_without_a_complete_key_is_never_matched():
+    # a null key never joins in SQL
+    assert classify([["1", "MAIN ST", "30", "30.1"]], [[None, "MAIN ST", "30", "30.1"]]) == [
+        ("1", "insert", ["crash_id", "rpt_street_name", "crash_speed_limit"], ["latitude"]),
+    ]
+
+
+def test_compare_classifications_counts_differences():
+    imported = make_frame([["1", "ELM ST", "30", "30.1"], ["2", "MAIN ST", "30", "30.1"]])
+    existing = make_frame([["1", "MAIN ST", "30", "30.1"]])
+    memory_classification = vectorized.classify_records(imported, existing, KEY_COLUMNS, COMPARED_COLUMNS, NO_OVERRIDE_COLUMNS)
+
+    # the SQL path's classification table is read back with its arrays as COPY writes them
+    sql_classification = memory_classification.copy()
+    for column in ["changed_columns", "important_changed_columns"]:
+        sql_classification[column] = sql_classification[column].map(vectorized.format_copy_array)
+    assert vectorized.compare_classifications(sql_classification, memory_classification, KEY_COLUMNS) == 0
+
+    sql_classification.loc[0, "action"] = "conflict"
+    assert vectorized.compare_classifications(sql_classification, memory_classification, KEY_COLUMNS) == 2
+
+
+DATABASE_URL = os.getenv("CRIS_IMPORT_TEST_DATABASE_URL")
+
+IMPORT_SCHEMA = "cris_import_test"
+OUTPUT_MAP = {"crash": "cris_import_test_crashes"}
+
+TARGET_RECORDS = [
+    (1, "MAIN ST", 30, "30.1"),
+    (2, None, 30, "30.1"),
+    (3, "", None, "30.1"),
+    (4, "MAIN ST", 30, "30.1"),
+    (5, "MAIN ST", 30, "30.1"),
+    (6, "MAIN ST", 30, "30.10"),
+]
+
+# in the order they're loaded; crash 5 is imported twice, and the second one loaded is the one which counts
+IMPORTED_RECORDS = [
+    (1, "MAIN ST", 30, "30.1"),
+    (2, "", 30, "30.1"),
+    (3, None, 35, "30.1"),
+    (4, "MAIN ST", 30, "30.2"),
+    (5, "MAIN ST", 30, "30.1"),
+    (5, "ELM ST", 40, "30.2"),
+    (6, "MAIN ST", 30, "30.1"),
+    (7, "MAIN ST", None, None),
+]
+
+
+@pytest.fixture
+def database():
+    if not DATABASE_URL:
+        pytest.skip("CRIS_IMPORT_TEST_DATABASE_URL isn't set")
+    pg = psycopg2.connect(DATABASE_URL)
+    cursor = pg.cursor()
+    cursor.execute(f"drop schema if exists {IMPORT_SCHEMA} cascade")
+    cursor.execute(f"drop table if exists public.{OUTPUT_MAP['crash']}")
+    cursor.execute(f"create schema {IMPORT_SCHEMA}")
+    columns = "crash_id integer, rpt_street_name character varying, crash_speed_limit integer, latitude numeric"
+    cursor.execute(f"create table public.{OUTPUT_MAP['crash']} ({columns}, primary key (crash_id))")
+    cursor.execute(f"create table {IMPORT_SCHEMA}.crash ({columns}, {util.IMPORT_ROW_COLUMN} bigint generated always as identity)")
+    cursor.executemany(f"insert into public.{OUTPUT_MAP['crash']} values (%s, %s, %s, %s)", TARGET_RECORDS)
+    cursor.executemany(f"insert into {IMPORT_SCHEMA}.crash (crash_id, rpt_street_name, crash_speed_limit, latitude) values (%s, %s, %s, %s)", IMPORTED_RECORDS)
+    pg.commit()
+    try:
+        yield pg
+    finally:
+        pg.rollback()
+        cursor = pg.cursor()
+        cursor.execute(f"drop schema if exists {IMPORT_SCHEMA} cascade")
+        cursor.execute(f"drop table if exists public.{OUTPUT_MAP['crash']}")
+        pg.commit()
+        pg.close()
+
+
+def test_engines_agree_with_each_other(database):
+    target_columns = COMPARED_COLUMNS
+    input_column_names = COLUMN_NAMES
+    _, column_comparisons, column_aggregators, _, _, important_column_aggregators = util.get_column_operators(
+        target_columns, NO_OVERRIDE_COLUMNS, input_column_names, "crash", OUTPUT_MAP, IMPORT_SCHEMA
+    )
+
+    sql_counts = util.classify_imported_records(
+        database, OUTPUT_MAP, "crash", KEY_COLUMNS, column_comparisons, column_aggregators, important_column_aggregators, IMPORT_SCHEMA
+    )
+    sql_classification = vectorized.read_classification_table(database, "crash", KEY_COLUMNS, IMPORT_SCHEMA)
+
+    memory_counts, memory_classification = vectorized.classify_imported_records(
+        database, OUTPUT_MAP, "crash", KEY_COLUMNS, target_columns, NO_OVERRIDE_COLUMNS, input_column_names, IMPORT_SCHEMA
+    )
+
+    assert vectorized.compare_classifications(sql_classification, memory_classification, KEY_COLUMNS) == 0
+    assert memory_counts == sql_counts
+    assert sql_counts == {"insert": 1, "unchanged": 4, "update": 1, "conflict": 1}
+
+    # only the last loaded of crash 5's records is classified
+    actions = dict(zip(memory_classification["crash_id"], memory_classification["action"]))
+    assert actions["5"] == "conflict"
+    assert len(memory_classification) == 7
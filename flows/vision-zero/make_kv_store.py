@@ -52,7 +52,15 @@ kv_store = {
 
     "DB_PERMISSION_SCHEMAS": os.getenv("DB_PERMISSION_SCHEMAS"),
     "DB_BASTION_HOST": os.getenv("DB_BASTION_HOST"),
-    "DB_RDS_HOST": os.getenv("DB_RDS_HOST")
+    "DB_RDS_HOST": os.getenv("DB_RDS_HOST"),
+
+    "CRIS_IMPORT_STATE_DIRECTORY": os.getenv("CRIS_IMPORT_STATE_DIRECTORY"),
+    "CRIS_IMPORT_CONCURRENT_LOGICAL_GROUPS": os.getenv("CRIS_IMPORT_CONCURRENT_LOGICAL_GROUPS"),
+    "CRIS_IMPORT_MAX_DB_CONNECTIONS": os.getenv("CRIS_IMPORT_MAX_DB_CONNECTIONS"),
+    "CRIS_IMPORT_S3_UPLOAD_WORKERS": os.getenv("CRIS_IMPORT_S3_UPLOAD_WORKERS"),
+    "CRIS_IMPORT_CHANGE_LOG_S3_PATH": os.getenv("CRIS_IMPORT_CHANGE_LOG_S3_PATH"),
+    "CRIS_IMPORT_ALIGN_WAIT_MINUTES": os.getenv("CRIS_IMPORT_ALIGN_WAIT_MINUTES"),
+    "CRIS_IMPORT_CHECKPOINT_SECONDS": os.getenv("CRIS_IMPORT_CHECKPOINT_SECONDS"),
 }
 
 json = json.dumps(kv_store)